@@ -0,0 +1,74 @@
+# Per-group result checkpoints for long sweeps
+# Daman Dhaliwal
+
+# import libraries
+import pandas as pd
+import numpy as np
+import os
+import json
+import hashlib
+import mmap
+
+from utils import paths
+
+
+def frame_hash(df):
+    # content hash of the estimation frame, so a rebuilt sample starts a new checkpoint
+    return hashlib.sha1(pd.util.hash_pandas_object(df, index = False).values.tobytes()).hexdigest()[:12]
+
+def array_hash(arr):
+    # a memory-mapped design is identified by its file (whose name carries its spec hash),
+    # so it is not read end to end just to be hashed
+    if isinstance(arr, np.memmap) and isinstance(arr.base, mmap.mmap):
+        stat = os.stat(arr.filename)
+        payload = f"{arr.filename}:{stat.st_size}:{stat.st_mtime_ns}:{arr.offset}:{arr.shape}"
+        return hashlib.sha1(payload.encode()).hexdigest()[:12]
+    return hashlib.sha1(np.ascontiguousarray(arr).tobytes()).hexdigest()[:12]
+
+def checkpoint_path(name, spec, seed = None):
+    payload = json.dumps(spec, sort_keys = True, default = str)
+    spec_hash = hashlib.sha1(payload.encode()).hexdigest()[:12]
+
+    checkpoint_dir = os.path.join(paths()['data'], 'checkpoints')
+    os.makedirs(checkpoint_dir, exist_ok = True)
+    suffix = f"_seed{seed}" if seed is not None else ""
+    return os.path.join(checkpoint_dir, f"{name}_{spec_hash}{suffix}.jsonl")
+
+def load_checkpoint(path, resume = True):
+    # finished results keyed by group, empty (and truncated) when not resuming
+    if not resume:
+        open(path, 'w').close()
+        return {}
+
+    done = {}
+    if not os.path.exists(path):
+        return done
+
+    valid = []
+    with open(path) as f:
+        for line in f:
+            # a half-written last line from a killed job is simply redone
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            done[row['key']] = row['result']
+            valid.append(json.dumps(row) + '\n')
+
+    # drop the broken tail so new rows are not appended onto it
+    with open(path, 'w') as f:
+        f.writelines(valid)
+
+    return done
+
+def _to_json(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+def append_checkpoint(path, key, result):
+    row = {'key': str(key), 'result': {k: _to_json(v) for k, v in result.items()}}
+    with open(path, 'a') as f:
+        f.write(json.dumps(row) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
@@ -4,83 +4,76 @@
 # import libraries
 import pandas as pd
 import numpy as np
+import polars as pl
 import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import matplotlib.pyplot as plt
 import statsmodels.formula.api as smf
 
-from utils import paths
-from data_prep import merged_combined, merged_survival
+from utils import paths, available_cores
+from features import growth_frame, survival_lazy, growth_lazy, growth_windows
+from data_prep import ensure_panel_dataset, scan_panel
+from describe import describe
+from fe_ols import fit_fe_ols, print_summary
+from streaming_ols import stream_ols
+from profiling import timed, stage
 
 # output summary statistics
-def summary_stats(overwrite=False):
-    data = merged_survival(overwrite=overwrite).to_pandas()
-    
+@timed(rows=None)
+def summary_stats(overwrite=False, by=()):
+    # one streaming pass per table; by=('state',) / ('naics2',) adds subgroup rows
     required_cols = ['survived_2024', 'ec', 'employees', 'sales', 'fips', 'naics', 'naics2']
-    data = data.dropna(subset=required_cols)
-    
+    variables = ['survived_2024', 'sales', 'employees', 'ec', 'clustering', 'civic']
+
+    data = survival_lazy(required_cols=required_cols, overwrite=overwrite)
+    stats = describe(data, variables, by=by)
+
     # For growth sample (survivors only) - keep separate
-    df = merged_combined(overwrite=overwrite).to_pandas()
-    
-    data_2019 = df[df['file_year'] == 2019][['abi', 'sales']].copy()
-    data_2019 = data_2019.rename(columns={'sales': 'sales_2019'})
-    
-    data_2024 = df[df['file_year'] == 2024][['abi', 'sales']].copy()
-    data_2024 = data_2024.rename(columns={'sales': 'sales_2024'})
-    
-    growth = data_2019.merge(data_2024, on='abi', how='inner')
-    growth = growth[growth['sales_2019'] > 0]
-    growth = growth[growth['sales_2024'] > 0]
-    growth['log_sales_change'] = np.log1p(growth['sales_2024']) - np.log1p(growth['sales_2019'])
+    growth = growth_lazy(required_cols=[], overwrite=overwrite)
+    growth_row = describe(growth, ['log_sales_change'], by=by)
+
+    # growth row after employees, as in Table 1
+    order = variables[:3] + ['log_sales_change'] + variables[3:]
+    stats = pd.concat([stats, growth_row]).reset_index()
+    stats['variable'] = pd.Categorical(stats['variable'], categories=order, ordered=True)
+    stats = stats.sort_values(list(by) + ['variable'])
+    stats['variable'] = stats['variable'].astype(str)
+    stats = stats.set_index(list(by) + ['variable'])
+    if not by:
+        stats.index.name = None
 
-    variables = ['survived_2024', 'sales', 'employees', 'ec', 'clustering', 'civic']
-    
-    stats = data[variables].agg(['count', 'mean', 'std', 'min', 'median', 'max']).T
-    stats.columns = ['N', 'Mean', 'SD', 'Min', 'Median', 'Max']
-    stats['N'] = stats['N'].astype(int)
-    
-    # Add growth row
-    growth_row = pd.DataFrame({
-        'N': [len(growth)],
-        'Mean': [growth['log_sales_change'].mean()],
-        'SD': [growth['log_sales_change'].std()],
-        'Min': [growth['log_sales_change'].min()],
-        'Median': [growth['log_sales_change'].median()],
-        'Max': [growth['log_sales_change'].max()],
-    }, index=['log_sales_change'])
-    
-    stats = pd.concat([stats.iloc[:3], growth_row, stats.iloc[3:]])
-    
     print(stats.round(3).to_string())
-    
+
     return stats
 
-def run_placebo(overwrite=False):
-    df = merged_combined(overwrite=overwrite).to_pandas()
-    
-    # Baseline: 2016
-    data_2016 = df[df['file_year'] == 2016][['abi', 'fips', 'sales', 'employees', 'naics', 'ec', 'clustering', 'civic']].copy()
-    data_2016 = data_2016.rename(columns={'sales': 'sales_2016', 'employees': 'emp_2016'})
-    
-    # Outcome: 2019
-    data_2019 = df[df['file_year'] == 2019][['abi', 'sales']].copy()
-    data_2019 = data_2019.rename(columns={'sales': 'sales_2019'})
-    
-    merged = data_2016.merge(data_2019, on='abi', how='left')
-    merged['sales_2019'] = merged['sales_2019'].fillna(0)
-    
-    merged = merged.dropna(subset=['sales_2016', 'ec', 'fips', 'emp_2016', 'naics', 'clustering', 'civic'])
-    merged = merged[merged['sales_2016'] > 0]
-    
-    merged['survived_2019'] = (merged['sales_2019'] > 0).astype(int)
-    
-    # Standardize
-    merged['ec_std'] = (merged['ec'] - merged['ec'].mean()) / merged['ec'].std()
-    merged['clustering_std'] = (merged['clustering'] - merged['clustering'].mean()) / merged['clustering'].std()
-    merged['civic_std'] = (merged['civic'] - merged['civic'].mean()) / merged['civic'].std()
-    merged['log_employees'] = np.log1p(merged['emp_2016'])
-    merged['state'] = merged['fips'].astype(str).str[:2]
-    merged['naics2'] = merged['naics'].astype(str).str[:2]
-    
+def panel_stats(by=('file_year',), variables=('sales', 'employees', 'ec', 'clustering', 'civic'),
+                overwrite=False):
+    # Table 1 for the full multi-year panel, straight off the partitioned store
+    ensure_panel_dataset(overwrite=overwrite)
+    stats = describe(scan_panel(), list(variables), by=by)
+
+    print(stats.round(3).to_string())
+
+    return stats
+
+def run_placebo(overwrite=False, streaming=False):
+    # Baseline: 2016, Outcome: 2019, all baseline firms
+    required_cols = ['sales_2016', 'ec', 'fips', 'emp_2016', 'naics', 'clustering', 'civic']
     formula = "survived_2019 ~ ec_std + clustering_std + civic_std + log_employees + C(state) + C(naics2)"
+
+    # out-of-core: sufficient statistics over row batches instead of a pandas frame
+    if streaming:
+        lf = growth_lazy(baseline_year=2016, outcome_year=2019, required_cols=required_cols,
+                         survivors_only=False, overwrite=overwrite)
+        result = stream_ols(lf.with_columns(pl.col('log_emp_2016').alias('log_employees')), formula)
+        print_summary(result)
+        return result
+
+    merged = growth_frame(baseline_year=2016, outcome_year=2019, required_cols=required_cols,
+                          survivors_only=False, overwrite=overwrite)
+    merged['log_employees'] = merged['log_emp_2016']
+    
     model = smf.ols(formula=formula, data=merged).fit(cov_type='cluster', cov_kwds={'groups': merged['fips']})
     
     print(model.summary())
@@ -88,5 +81,75 @@ def run_placebo(overwrite=False):
     return model
 
 
+PLACEBO_FORMULA = "survived ~ ec_std + clustering_std + civic_std + log_employees + C(state) + C(naics2)"
+PLACEBO_VARS = ['ec_std', 'clustering_std', 'civic_std', 'log_employees']
+
+def placebo_windows(horizon=3, last_outcome=2019):
+    # every pre-period window of the given length the panel covers, ending by 2019
+    ensure_panel_dataset()
+    years = set(scan_panel(columns=['file_year']).unique().collect()['file_year'].to_list())
+    return [(b, b + horizon) for b in sorted(years) if b + horizon in years and b + horizon <= last_outcome]
+
+def _fit_window(window, data):
+    with stage('placebo.window', window=f"{window[0]}-{window[1]}") as record:
+        result = fit_fe_ols(PLACEBO_FORMULA, data, cluster='fips')
+        record['rows'] = result['nobs']
+    row = {'baseline_year': window[0], 'outcome_year': window[1], 'nobs': result['nobs']}
+    for v in PLACEBO_VARS:
+        row.update({f'{v}_coef': result['params'][v], f'{v}_se': result['bse'][v], f'{v}_pval': result['pvalues'][v]})
+    return row
+
+@timed(rows=None)
+def run_placebo_sweep(windows=None, workers=None, overwrite=False):
+    # all windows come from one stacked panel; each window's FE regression runs on its own worker
+    windows = windows or placebo_windows()
+    if not windows:
+        raise ValueError("No placebo windows: the panel has no pre-period pair of the requested horizon")
+    panel = growth_windows(windows, overwrite=overwrite)
+    groups = {key: df for key, df in panel.groupby(['baseline_year', 'outcome_year'])}
+    if not groups:
+        raise ValueError(f"No firms in any placebo window {windows}")
+
+    workers = max(1, min(workers or available_cores(), len(groups)))
+    print(f"Fitting {len(groups)} placebo windows on {workers} workers")
+    if workers == 1:
+        rows = [_fit_window(key, df) for key, df in groups.items()]
+    else:
+        ctx = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+            futures = [pool.submit(_fit_window, key, df) for key, df in groups.items()]
+            rows = [future.result() for future in as_completed(futures)]
+
+    results = pd.DataFrame(rows).sort_values(['baseline_year', 'outcome_year']).reset_index(drop=True)
+
+    for v in PLACEBO_VARS[:3]:
+        print(f"\n{v}:")
+        for _, row in results.iterrows():
+            pval = row[f'{v}_pval']
+            sig = '***' if pval < 0.01 else '**' if pval < 0.05 else '*' if pval < 0.1 else ''
+            print(f"   {int(row['baseline_year'])}->{int(row['outcome_year'])} {row[f'{v}_coef']:>12.4f} {row[f'{v}_se']:>12.4f} {pval:>10.4f} {sig:>5}")
+
+    results.to_csv(os.path.join(paths()['data'], 'placebo_sweep.csv'), index=False)
+    plot_placebo_sweep(results)
+
+    return results
+
+def plot_placebo_sweep(results):
+    fig, axes = plt.subplots(1, 3, figsize=(18, 5), sharey=True)
+    labels = {'ec_std': 'Economic Connectedness', 'clustering_std': 'Cohesion (Clustering)', 'civic_std': 'Civic Engagement'}
+    windows = [f"{b}-{o}" for b, o in zip(results['baseline_year'], results['outcome_year'])]
+
+    for ax, v in zip(axes, PLACEBO_VARS[:3]):
+        ax.errorbar(windows, results[f'{v}_coef'], yerr=1.96 * results[f'{v}_se'], fmt='o', capsize=4)
+        ax.axhline(0, color='black', linestyle='--', linewidth=1, alpha=0.7)
+        ax.set_title(labels[v], fontsize=14, fontweight='bold')
+        ax.set_xlabel('Placebo window', fontsize=12)
+    axes[0].set_ylabel('Coefficient on survival', fontsize=12)
+
+    plt.tight_layout()
+    os.makedirs(paths()['plots'], exist_ok=True)
+    fig.savefig(os.path.join(paths()['plots'], 'placebo_sweep.png'), dpi=300)
+
+
 if __name__ == "__main__":
     summary_stats()
\ No newline at end of file
@@ -5,13 +5,366 @@
 import polars as pl
 import pandas as pd
 import numpy as np
-from utils import paths
+from utils import paths, available_cores
+from profiling import timed, stage
 import os
 import glob
 import re
+import time
+import json
+import hashlib
+import shutil
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 
-def load_data(overwrite = False):
+# shared schema for the raw vendor files, used by both the eager and lazy readers
+def _business_columns(year):
+    return [
+        pl.col("ABI").cast(pl.String).alias("abi"),
+        pl.col("FIPS CODE").cast(pl.String).str.zfill(5).alias("fips"),
+        pl.col("BUSINESS STATUS CODE").cast(pl.String).alias("status_code"),
+        pl.col("YEAR ESTABLISHED").cast(pl.Int32, strict=False).alias("year_established"),
+        pl.col("EMPLOYEE SIZE (5) - LOCATION").cast(pl.Int32, strict=False).alias("employees"),
+        pl.col("SALES VOLUME (9) - LOCATION").cast(pl.Float64, strict=False).alias("sales"),
+        pl.col("PRIMARY NAICS CODE").cast(pl.String).alias("naics"),
+        pl.lit(year).alias("file_year"),
+    ]
+
+def _business_filter():
+    return pl.col("abi").is_not_null() & pl.col("fips").is_not_null()
+
+# compact dtypes: integer ABI/NAICS, categorical codes, small ints for years and flags.
+# sales stays Float64 since the growth outcomes are small log differences of it
+COMPACT_DTYPES = {
+    'abi': pl.UInt64,
+    'fips': pl.Categorical,
+    'status_code': pl.Categorical,
+    'naics': pl.UInt32,
+    'year_established': pl.Int16,
+    'file_year': pl.Int16,
+    'firm_age': pl.Int16,
+    'exit_year': pl.Int16,
+    'survival_years': pl.Int8,
+    'state': pl.Categorical,
+    'naics2': pl.Categorical,
+    'naics4': pl.Categorical,
+}
+
+# state and industry codes as (source column, leading digits)
+CODE_COLUMNS = {'state': ('fips', 2), 'naics2': ('naics', 2), 'naics4': ('naics', 4)}
+
+def code_columns(names, codes = CODE_COLUMNS):
+    # expressions for the codes missing from names, sliced out of fips/naics
+    return {
+        code: pl.col(CODE_COLUMNS[code][0]).cast(pl.String).str.slice(0, CODE_COLUMNS[code][1])
+        for code in codes if code not in names and CODE_COLUMNS[code][0] in names
+    }
+
+def compact_schema(frame):
+    names = frame.collect_schema().names() if isinstance(frame, pl.LazyFrame) else frame.columns
+
+    # derive the codes every script slices out of fips/naics, while they are still strings
+    derived = code_columns(names)
+    frame = frame.with_columns([expr.alias(name) for name, expr in derived.items()])
+
+    names = set(names) | set(derived)
+    return frame.with_columns([
+        pl.col(name).cast(dtype, strict=False) for name, dtype in COMPACT_DTYPES.items() if name in names
+    ])
+
+def _file_year(file):
+    return int(re.search(r'(\d{4})_Business', file).group(1))
+
+def _business_files():
+    data_dir = paths()['data_input']
+    bus_data_dir = os.path.join(data_dir, 'business_data')
+    search_pattern = os.path.join(bus_data_dir, "*_Business_Academic*.txt")
+    return glob.glob(search_pattern)
+
+def read_business_file(file):
+    year = _file_year(file)
+    df = pl.read_csv(
+        file,
+        encoding='utf8-lossy',
+        ignore_errors=True,
+    )
+    # Normalize column names to uppercase
+    df = df.rename({col: col.upper() for col in df.columns})
+
+    return df.select(_business_columns(year)).filter(_business_filter())
+
+def scan_business_file(file):
+    year = _file_year(file)
+    lf = pl.scan_csv(
+        file,
+        encoding='utf8-lossy',
+        ignore_errors=True,
+        # Normalize column names to uppercase
+        with_column_names=lambda cols: [col.upper() for col in cols],
+    )
+
+    return lf.select(_business_columns(year)).filter(_business_filter())
+
+# follow-up years checked for the 2019 baseline firms
+SURVIVAL_YEARS = range(2020, 2025)
+
+def build_survival(combined, baseline_year = 2019, years = SURVIVAL_YEARS):
+    years = sorted(years)
+    lazy = combined.lazy()
+
+    baseline = lazy.filter(pl.col("file_year") == baseline_year).select([
+        "abi", "fips", "employees", "sales", "naics", "year_established"
+    ])
+
+    # ABI x year presence in one group-by pass
+    presence = (
+        lazy.filter(pl.col("file_year").is_in(years))
+        .group_by("abi")
+        .agg([
+            (pl.col("file_year") == year).any().cast(pl.Int8).alias(f"survived_{year}")
+            for year in years
+        ])
+    )
+
+    flags = [f"survived_{year}" for year in years]
+
+    survival = baseline.join(presence, on="abi", how="left", maintain_order="left").with_columns([
+        pl.col(flag).fill_null(0) for flag in flags
+    ] + [
+        pl.col("naics").cast(pl.String).str.slice(0, 2).alias("naics2"),
+        (baseline_year - pl.col("year_established")).alias("firm_age"),
+    ]).with_columns(
+        # first follow-up year the firm is missing, null if it is seen every year
+        pl.coalesce([
+            pl.when(pl.col(f"survived_{year}") == 0).then(pl.lit(year, dtype=pl.Int32))
+            for year in years
+        ]).alias("exit_year"),
+    ).with_columns([
+        # discrete-time duration and event indicator for hazard models
+        (pl.col("exit_year").fill_null(years[-1]) - baseline_year).alias("survival_years"),
+        pl.col("exit_year").is_not_null().cast(pl.Int8).alias("exited"),
+    ])
+
+    if isinstance(combined, pl.LazyFrame):
+        return survival
+    return survival.collect()
+
+# streaming rebuild: scan every yearly file lazily and sink straight to parquet,
+# so peak memory is bounded by the streaming chunk size and not the input size
+def _rebuild_streaming(lazy, output_dir, chunk_size, survival_years = SURVIVAL_YEARS, compact = False):
+    combined_path = os.path.join(output_dir, "business_panel_full.parquet")
+    survival_path = os.path.join(output_dir, "business_survival_2019.parquet")
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    if compact:
+        lazy = compact_schema(lazy)
+
+    with pl.Config(streaming_chunk_size=chunk_size):
+        lazy.sink_parquet(combined_path, row_group_size=chunk_size)
+
+        combined = pl.scan_parquet(combined_path)
+        print(combined.head().collect())
+
+        survival = build_survival(combined, years=survival_years)
+        if compact:
+            survival = compact_schema(survival)
+        survival.sink_parquet(survival_path, row_group_size=chunk_size)
+
+        # save full csv
+        combined.sink_csv(os.path.join(output_dir, "business_panel_full.csv"))
+
+    return pl.scan_parquet(combined_path), pl.scan_parquet(survival_path)
+
+
+# parse one yearly file into its own parquet partition (runs in a worker process)
+def _ingest_year(file, partition_dir, streaming, chunk_size, file_hash=False):
+    start = time.perf_counter()
+    year = _file_year(file)
+    out_path = os.path.join(partition_dir, f"{year}.parquet")
+
+    with stage('data_prep.ingest_year', file_year=year) as record:
+        if streaming:
+            with pl.Config(streaming_chunk_size=chunk_size):
+                scan_business_file(file).sink_parquet(out_path, row_group_size=chunk_size)
+            rows = pl.scan_parquet(out_path).select(pl.len()).collect().item()
+        else:
+            df = read_business_file(file)
+            df.write_parquet(out_path)
+            rows = df.height
+        record['rows'] = rows
+
+    return {
+        'file': os.path.basename(file),
+        'file_year': year,
+        'rows': rows,
+        'bytes': os.path.getsize(file),
+        'seconds': time.perf_counter() - start,
+        # content hash for the manifest, read while the file is still in the page cache
+        'sha256': _file_hash(file) if file_hash else None,
+    }
+
+# a parsed year takes roughly this many times its raw file size in memory
+INGEST_MEMORY_FACTOR = 3
+
+def ingest_parallel(filenames, partition_dir, workers = None, memory_budget_gb = None,
+                    streaming = False, chunk_size = 250_000, hash_files = ()):
+    os.makedirs(partition_dir, exist_ok=True)
+
+    workers = workers or available_cores()
+    workers = min(workers, len(filenames))
+
+    # cap concurrent workers so the largest files still fit in the memory budget
+    if memory_budget_gb is not None and not streaming:
+        largest = max(os.path.getsize(file) for file in filenames)
+        per_worker = max(largest * INGEST_MEMORY_FACTOR, 1)
+        workers = max(1, min(workers, int(memory_budget_gb * 1024**3 // per_worker)))
+
+    # split the polars thread pool between workers instead of oversubscribing
+    threads = max(1, available_cores() // workers)
+    previous = os.environ.get('POLARS_MAX_THREADS')
+    os.environ['POLARS_MAX_THREADS'] = str(threads)
+
+    print(f"Ingesting {len(filenames)} files with {workers} workers ({threads} threads each)")
+
+    start = time.perf_counter()
+    stats = []
+    try:
+        # spawn, since polars is not fork-safe once its thread pool is running
+        ctx = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+            futures = [
+                pool.submit(_ingest_year, file, partition_dir, streaming, chunk_size, file in hash_files)
+                for file in filenames
+            ]
+            for future in as_completed(futures):
+                result = future.result()
+                print(f"   {result['file']}: {result['rows']:,} rows in {result['seconds']:.1f}s")
+                stats.append(result)
+    finally:
+        if previous is None:
+            os.environ.pop('POLARS_MAX_THREADS', None)
+        else:
+            os.environ['POLARS_MAX_THREADS'] = previous
+
+    elapsed = time.perf_counter() - start
+    report = pd.DataFrame(stats).sort_values('file_year')
+    report['rows_per_sec'] = report['rows'] / report['seconds']
+    report['mb_per_sec'] = report['bytes'] / 1024**2 / report['seconds']
+
+    print(report.drop(columns='sha256').round(1).to_string(index=False))
+    print(f"Total: {report['rows'].sum():,} rows, {report['bytes'].sum() / 1024**2:,.0f} MB in {elapsed:.1f}s "
+          f"({report['rows'].sum() / elapsed:,.0f} rows/s, {report['bytes'].sum() / 1024**2 / elapsed:,.1f} MB/s)")
+
+    return report
+
+
+# source-file fingerprints for incremental rebuilds
+MANIFEST_NAME = "manifest.json"
+
+def _file_hash(file, block_size = 8 * 1024**2):
+    digest = hashlib.sha256()
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _fingerprint(file, file_hash):
+    stat = os.stat(file)
+    return {
+        'file': os.path.basename(file),
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'sha256': file_hash,
+    }
+
+def read_manifest(partition_dir):
+    manifest_path = os.path.join(partition_dir, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+def write_manifest(partition_dir, manifest):
+    manifest_path = os.path.join(partition_dir, MANIFEST_NAME)
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+# years whose source file is new or changed since the partition was written, and the
+# content hashes computed on the way
+def stale_files(filenames, partition_dir):
+    manifest = read_manifest(partition_dir)
+    stale, hashes = [], {}
+
+    for file in filenames:
+        year = str(_file_year(file))
+        entry = manifest.get(year)
+        partition = os.path.join(partition_dir, f"{year}.parquet")
+        stat = os.stat(file)
+
+        if entry is None or not os.path.exists(partition) or entry['file'] != os.path.basename(file):
+            stale.append(file)
+        elif entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+            continue
+        elif entry['size'] != stat.st_size:
+            stale.append(file)
+        # only the mtime moved: the content hash decides
+        else:
+            hashes[file] = _file_hash(file)
+            if hashes[file] != entry['sha256']:
+                stale.append(file)
+            else:
+                manifest[year]['mtime'] = stat.st_mtime
+
+    if manifest:
+        write_manifest(partition_dir, manifest)
+
+    return stale, hashes
+
+def update_partitions(filenames, partition_dir, workers = None, memory_budget_gb = None,
+                      streaming = False, chunk_size = 250_000, incremental = True):
+    os.makedirs(partition_dir, exist_ok=True)
+
+    to_ingest, hashes = stale_files(filenames, partition_dir) if incremental else (list(filenames), {})
+    print(f"{len(to_ingest)} of {len(filenames)} yearly files need ingesting")
+
+    # files not hashed yet are hashed by the workers that parse them, in parallel
+    if to_ingest:
+        report = ingest_parallel(to_ingest, partition_dir, workers=workers, memory_budget_gb=memory_budget_gb,
+                                 streaming=streaming, chunk_size=chunk_size,
+                                 hash_files=[file for file in to_ingest if file not in hashes])
+        worker_hashes = dict(zip(report['file'], report['sha256']))
+        hashes.update({file: worker_hashes[os.path.basename(file)] for file in to_ingest if file not in hashes})
+
+    # record fingerprints, and drop partitions whose source file is gone
+    manifest = read_manifest(partition_dir)
+    for file in to_ingest:
+        manifest[str(_file_year(file))] = _fingerprint(file, hashes[file])
+
+    current = {str(_file_year(file)) for file in filenames}
+    removed = []
+    for year in list(manifest):
+        if year not in current:
+            del manifest[year]
+            removed.append(int(year))
+            partition = os.path.join(partition_dir, f"{year}.parquet")
+            if os.path.exists(partition):
+                os.remove(partition)
+
+    write_manifest(partition_dir, manifest)
+
+    # years re-ingested and years dropped; either means the panel must be rebuilt
+    return [_file_year(file) for file in to_ingest], sorted(removed)
+
+
+@timed()
+def load_data(overwrite = False, streaming = False, chunk_size = 250_000,
+              parallel = False, workers = None, memory_budget_gb = None,
+              incremental = False, survival_years = SURVIVAL_YEARS, compact = False,
+              refresh_merged = True):
+    # refresh_merged=False leaves the merged files and the partitioned store to the caller
+    # (the pipeline rebuilds them as their own nodes)
     path = paths()
     output_dir = path['data']
 
@@ -24,65 +377,56 @@ def load_data(overwrite = False):
         return combined, survival
 
     # Otherwise, rebuild from source
-    data_dir = paths()['data_input']
-    bus_data_dir = os.path.join(data_dir, 'business_data')
-    search_pattern = os.path.join(bus_data_dir, "*_Business_Academic*.txt")
-    filenames = glob.glob(search_pattern)
+    filenames = _business_files()
 
-    dfs = []
+    # parallel mode parses each year on a process pool into per-year parquet files,
+    # incremental mode does the same but only for years whose source file changed
+    if parallel or incremental:
+        partition_dir = os.path.join(output_dir, "business_panel_years")
+        changed, removed = update_partitions(filenames, partition_dir, workers=workers, memory_budget_gb=memory_budget_gb,
+                                             streaming=streaming, chunk_size=chunk_size, incremental=incremental)
+        if removed:
+            print(f"Removed years no longer in the source: {removed}")
 
-    for file in filenames:
-        print(file)
-        year = int(re.search(r'(\d{4})_Business', file).group(1))
-        df = pl.read_csv(
-            file,
-            encoding='utf8-lossy',
-            ignore_errors=True,
-        )
-        # Normalize column names to uppercase
-        df = df.rename({col: col.upper() for col in df.columns})
-
-        df = df.select([
-            pl.col("ABI").cast(pl.String).alias("abi"),
-            pl.col("FIPS CODE").cast(pl.String).str.zfill(5).alias("fips"),
-            pl.col("BUSINESS STATUS CODE").cast(pl.String).alias("status_code"),
-            pl.col("YEAR ESTABLISHED").cast(pl.Int32, strict=False).alias("year_established"),
-            pl.col("EMPLOYEE SIZE (5) - LOCATION").cast(pl.Int32, strict=False).alias("employees"),
-            pl.col("SALES VOLUME (9) - LOCATION").cast(pl.Float64, strict=False).alias("sales"),
-            pl.col("PRIMARY NAICS CODE").cast(pl.String).alias("naics"),
-            pl.lit(year).alias("file_year"),
-        ]).filter(
-            pl.col("abi").is_not_null() &
-            pl.col("fips").is_not_null()
-        )
-        dfs.append(df)
+        if incremental and not changed and not removed and os.path.exists(combined_path) and os.path.exists(survival_path):
+            print("Panel is up to date")
+            return load_data(overwrite=False)
 
-    # Combine into full panel dataset
-    combined = pl.concat(dfs)
-    print(combined.head())
+        source = pl.scan_parquet([
+            os.path.join(partition_dir, f"{_file_year(file)}.parquet") for file in filenames
+        ])
+    else:
+        source = None
 
-    # building a cleaned survival dataset for survival analysis
-    baseline = combined.filter(pl.col("file_year") == 2019).select([
-        "abi", "fips", "employees", "sales", "naics", "year_established"
-    ])
+    # streaming mode returns LazyFrames over the written parquet files
+    if streaming:
+        if source is None:
+            source = pl.concat([scan_business_file(file) for file in filenames])
+        combined, survival = _rebuild_streaming(source, output_dir, chunk_size, survival_years, compact)
+        if incremental and refresh_merged:
+            _refresh_merged()
+        return combined, survival
 
-    # Get ABIs present in each year
-    abis_by_year = {}
-    for year in [2020, 2021, 2022, 2023, 2024]:
-        abis_by_year[year] = set(
-            combined.filter(pl.col("file_year") == year)["abi"].to_list()
-        )
+    if source is not None:
+        combined = source.collect()
+    else:
+        dfs = []
 
-    # Add survival flags
-    survival = baseline.with_columns([
-        pl.col("abi").is_in(abis_by_year[2020]).cast(pl.Int8).alias("survived_2020"),
-        pl.col("abi").is_in(abis_by_year[2021]).cast(pl.Int8).alias("survived_2021"),
-        pl.col("abi").is_in(abis_by_year[2022]).cast(pl.Int8).alias("survived_2022"),
-        pl.col("abi").is_in(abis_by_year[2023]).cast(pl.Int8).alias("survived_2023"),
-        pl.col("abi").is_in(abis_by_year[2024]).cast(pl.Int8).alias("survived_2024"),
-        pl.col("naics").str.slice(0, 2).alias("naics2"),
-        (2019 - pl.col("year_established")).alias("firm_age"),
-    ])
+        for file in filenames:
+            print(file)
+            dfs.append(read_business_file(file))
+
+        # Combine into full panel dataset
+        combined = pl.concat(dfs)
+
+    # building a cleaned survival dataset for survival analysis
+    survival = build_survival(combined, years=survival_years)
+
+    # compact schema: integer ids, categorical codes, precomputed state/naics2/naics4
+    if compact:
+        combined = compact_schema(combined)
+        survival = compact_schema(survival)
+    print(combined.head())
 
     # save
     os.makedirs(output_dir, exist_ok=True)
@@ -94,8 +438,21 @@ def load_data(overwrite = False):
     # save full csv
     combined.write_csv(os.path.join(output_dir, "business_panel_full.csv"))
 
+    # the merged caches are derived from the panel, so refresh them too
+    if incremental and refresh_merged:
+        _refresh_merged()
+
     return combined, survival
 
+def _refresh_merged():
+    merged_survival(overwrite=True)
+    merged_combined(overwrite=True)
+
+    # keep the partitioned store in step with the merged panel
+    dataset_dir = os.path.join(paths()['data'], PANEL_DATASET)
+    if os.path.exists(dataset_dir):
+        write_panel_dataset(partition_by=list(_hive_schema(dataset_dir)), overwrite=True)
+
 # social capital data
 def load_social_capital():
     path = paths()
@@ -114,6 +471,7 @@ def load_social_capital():
     return sc
 
 # merge the datasets
+@timed()
 def merged_survival(overwrite = False):
     path = paths()
     output_path = os.path.join(path['data'], "survival_merged.parquet")
@@ -125,6 +483,7 @@ def merged_survival(overwrite = False):
     sc = load_social_capital()
     
     # Merge datasets on FIPS code
+    sc = sc.with_columns(pl.col("fips").cast(survival.schema["fips"]))
     merged = survival.join(sc, on="fips", how="left")
     
     # Check merge rate
@@ -136,6 +495,7 @@ def merged_survival(overwrite = False):
     
     return merged
 
+@timed()
 def merged_combined(overwrite = False):
     path = paths()
     output_path = os.path.join(path['data'], "combined_merged.parquet")
@@ -147,6 +507,7 @@ def merged_combined(overwrite = False):
     sc = load_social_capital()
     
     # Merge datasets on FIPS code
+    sc = sc.with_columns(pl.col("fips").cast(combined.schema["fips"]))
     merged = combined.join(sc, on="fips", how="left")
     
     # Check merge rate
@@ -156,4 +517,161 @@ def merged_combined(overwrite = False):
     # Save
     merged.write_parquet(output_path)
     
-    return merged
\ No newline at end of file
+    return merged
+
+
+# hive-partitioned copy of the merged panel: file_year=YYYY[/state=SS][/naics2=NN]
+PANEL_DATASET = "panel_dataset"
+PARTITION_KEYS = {'file_year': pl.Int32, 'state': pl.String, 'naics2': pl.String}
+
+@timed()
+def write_panel_dataset(partition_by = ('file_year',), overwrite = False):
+    dataset_dir = os.path.join(paths()['data'], PANEL_DATASET)
+    merged_path = os.path.join(paths()['data'], "combined_merged.parquet")
+
+    if not os.path.exists(merged_path):
+        merged_combined()
+
+    # reuse the store unless the merged panel has been rebuilt since it was written
+    if not overwrite and os.path.exists(dataset_dir) and \
+            os.path.getmtime(dataset_dir) >= os.path.getmtime(merged_path):
+        return dataset_dir
+
+    partition_by = list(partition_by)
+    if partition_by[0] != 'file_year' or not set(partition_by) <= set(PARTITION_KEYS):
+        raise ValueError(f"partition_by must start with 'file_year' and use only {list(PARTITION_KEYS)}")
+
+    # state/naics2 from a compact panel are kept as they are
+    lf = pl.scan_parquet(merged_path)
+    names = lf.collect_schema().names()
+    lf = lf.with_columns([expr.alias(name) for name, expr in code_columns(names, ['state', 'naics2']).items()])
+
+    if os.path.exists(dataset_dir):
+        shutil.rmtree(dataset_dir)
+
+    # one year in memory at a time
+    years = lf.select(pl.col("file_year").unique()).collect()["file_year"].to_list()
+    sub_keys = partition_by[1:]
+
+    for year in sorted(years):
+        df = lf.filter(pl.col("file_year") == year).drop("file_year").collect()
+        year_dir = os.path.join(dataset_dir, f"file_year={year}")
+
+        if sub_keys:
+            df.write_parquet(year_dir, partition_by=sub_keys)
+        else:
+            os.makedirs(year_dir, exist_ok=True)
+            df.write_parquet(os.path.join(year_dir, "00000000.parquet"))
+
+    print(f"Wrote {len(years)} years to {dataset_dir} partitioned by {partition_by}")
+
+    return dataset_dir
+
+def _hive_schema(dataset_dir):
+    # read the partition keys off the first branch of the directory tree
+    schema = {}
+    current = dataset_dir
+    while True:
+        subdirs = sorted(d for d in os.listdir(current) if '=' in d)
+        if not subdirs:
+            return schema
+        key = subdirs[0].split('=', 1)[0]
+        schema[key] = PARTITION_KEYS[key]
+        current = os.path.join(current, subdirs[0])
+
+def scan_panel(years = None, columns = None, states = None, naics2 = None):
+    dataset_dir = os.path.join(paths()['data'], PANEL_DATASET)
+
+    lf = pl.scan_parquet(dataset_dir, hive_partitioning=True, hive_schema=_hive_schema(dataset_dir))
+
+    # partition columns prune whole directories, the rest is pushed into the parquet reader
+    if years is not None:
+        lf = lf.filter(pl.col("file_year").is_in(list(years)))
+    if states is not None:
+        lf = lf.filter(pl.col("state").is_in(list(states)))
+    if naics2 is not None:
+        lf = lf.filter(pl.col("naics2").is_in(list(naics2)))
+    if columns is not None:
+        lf = lf.select(columns)
+
+    return lf
+
+def ensure_panel_dataset(overwrite = False):
+    dataset_dir = os.path.join(paths()['data'], PANEL_DATASET)
+
+    if not overwrite:
+        partition_by = list(_hive_schema(dataset_dir)) if os.path.exists(dataset_dir) else ['file_year']
+        return write_panel_dataset(partition_by=partition_by)
+
+    merged_combined(overwrite=True)
+    partition_by = list(_hive_schema(dataset_dir)) if os.path.exists(dataset_dir) else ['file_year']
+    return write_panel_dataset(partition_by=partition_by, overwrite=True)
+
+def load_panel(years = None, columns = None, states = None, naics2 = None, overwrite = False):
+    ensure_panel_dataset(overwrite=overwrite)
+
+    return scan_panel(years=years, columns=columns, states=states, naics2=naics2).collect()
+
+
+# baseline / outcome growth panels built straight off the partitioned store
+GROWTH_COLUMNS = ['abi', 'fips', 'sales', 'employees', 'naics', 'ec', 'clustering', 'civic']
+
+def consecutive_pairs(years):
+    years = sorted(years)
+    return list(zip(years[:-1], years[1:]))
+
+def growth_panels(pairs, columns = GROWTH_COLUMNS):
+    # stacked long panel: one row per baseline firm and (baseline_year, outcome_year) pair,
+    # outcome sales left-joined and filled with 0 for firms that disappeared
+    pairs = sorted(set((int(b), int(o)) for b, o in pairs))
+    if not pairs:
+        raise ValueError("growth_panels needs at least one (baseline_year, outcome_year) pair")
+    years = sorted({y for pair in pairs for y in pair})
+    columns = list(dict.fromkeys(['abi', 'sales'] + list(columns)))
+
+    ensure_panel_dataset()
+    # the store's state/naics codes come along, so the features need not slice them again
+    stored = scan_panel(years=years).collect_schema().names()
+    columns += [c for c in CODE_COLUMNS if c in stored and c not in columns]
+    panel = scan_panel(years=years, columns=columns + ['file_year'])
+
+    # one self-join per horizon covers every pair with that gap
+    horizons = {}
+    for b, o in pairs:
+        horizons.setdefault(o - b, []).append(b)
+
+    frames = []
+    for horizon, bases in sorted(horizons.items()):
+        baseline = (
+            panel.filter(pl.col("file_year").is_in(bases))
+            .rename({"file_year": "baseline_year"})
+            .with_columns((pl.col("baseline_year") + horizon).alias("outcome_year"))
+        )
+        outcome = (
+            panel.filter(pl.col("file_year").is_in([b + horizon for b in bases]))
+            .select([
+                "abi",
+                pl.col("file_year").alias("outcome_year"),
+                pl.col("sales").alias("sales_outcome"),
+            ])
+        )
+        frames.append(baseline.join(outcome, on=["abi", "outcome_year"], how="left", maintain_order="left"))
+
+    lf = pl.concat(frames) if len(frames) > 1 else frames[0]
+
+    return lf.with_columns(
+        pl.col("sales_outcome").fill_null(0)
+    ).with_columns(
+        (pl.col("sales_outcome") > 0).cast(pl.Int64).alias("survived")
+    )
+
+def growth_panel(baseline_year = 2019, outcome_year = 2024, columns = GROWTH_COLUMNS):
+    b, o = baseline_year, outcome_year
+
+    # wide naming used by the estimators: sales_2019, emp_2019, sales_2024, survived_2024
+    return growth_panels([(b, o)], columns=columns).drop(["baseline_year", "outcome_year"]).rename({
+        "sales": f"sales_{b}",
+        "employees": f"emp_{b}",
+        "sales_outcome": f"sales_{o}",
+        "survived": f"survived_{o}",
+    }, strict=False)
@@ -0,0 +1,145 @@
+# Streaming descriptive statistics with mergeable accumulators
+# Daman Dhaliwal
+
+# import libraries
+import pandas as pd
+import numpy as np
+import polars as pl
+
+
+class KLLSketch:
+    # KLL quantile sketch: level h holds items of weight 2^h; a full level is sorted and
+    # every other item (random offset) promoted. Exact until more than `exact` items (2k by
+    # default) are seen, so memory stays O(k) per sketch however many groups are tracked.
+    def __init__(self, k = 1000, seed = 0, exact = None):
+        self.k = k
+        self.exact = 2 * k if exact is None else exact
+        self.levels = [np.empty(0)]
+        self.rng = np.random.default_rng(seed)
+
+    def _capacity(self, h):
+        depth = len(self.levels) - h - 1
+        return max(2, int(np.ceil(self.k * (2 / 3) ** depth)))
+
+    def _compress(self):
+        # lazy compaction: only while the sketch as a whole is over capacity, and then
+        # the lowest level that is full
+        while True:
+            size = sum(len(level) for level in self.levels)
+            if size <= self.exact or size <= sum(self._capacity(h) for h in range(len(self.levels))):
+                return
+            h = next(h for h, level in enumerate(self.levels) if len(level) >= self._capacity(h))
+            if h + 1 == len(self.levels):
+                self.levels.append(np.empty(0))
+            level = np.sort(self.levels[h])
+            # an odd item out stays behind so the total weight is preserved
+            keep = level[:1] if len(level) % 2 else np.empty(0)
+            level = level[len(keep):]
+            self.levels[h] = keep
+            self.levels[h + 1] = np.concatenate([self.levels[h + 1], level[self.rng.integers(2)::2]])
+
+    def update(self, values):
+        self.levels[0] = np.concatenate([self.levels[0], np.asarray(values, dtype = float)])
+        self._compress()
+
+    def merge(self, other):
+        for h, level in enumerate(other.levels):
+            if h == len(self.levels):
+                self.levels.append(np.empty(0))
+            self.levels[h] = np.concatenate([self.levels[h], level])
+        self._compress()
+
+    def quantile(self, q):
+        items = np.concatenate(self.levels)
+        if len(items) == 0:
+            return np.nan
+        weights = np.concatenate([np.full(len(level), 2.0 ** h) for h, level in enumerate(self.levels)])
+        order = np.argsort(items, kind = 'stable')
+        items, cum = items[order], np.cumsum(weights[order])
+        # midpoint rule, matching the interpolated median on small exact samples
+        target = q * cum[-1]
+        lo = np.searchsorted(cum, target, side = 'left')
+        hi = np.searchsorted(cum, target, side = 'right')
+        if cum[min(lo, len(cum) - 1)] == target and hi < len(items):
+            return (items[lo] + items[hi]) / 2
+        return items[min(lo, len(items) - 1)]
+
+
+def merge_moments(a, b):
+    # Chan et al. pairwise update of (n, mean, M2, min, max)
+    n = a[0] + b[0]
+    if n == 0:
+        return a
+    delta = b[1] - a[1]
+    mean = a[1] + delta * b[0] / n
+    m2 = a[2] + b[2] + delta ** 2 * a[0] * b[0] / n
+    return (n, mean, m2, min(a[3], b[3]), max(a[4], b[4]))
+
+EMPTY_MOMENTS = (0, 0.0, 0.0, np.inf, -np.inf)
+
+def _batch_moments(batch, variables, by):
+    # per-group (n, mean, M2, min, max) for one batch, computed by polars
+    aggs = []
+    for v in variables:
+        aggs += [
+            pl.col(v).count().alias(f"{v}__n"),
+            pl.col(v).mean().alias(f"{v}__mean"),
+            (pl.col(v).var(ddof = 0) * pl.col(v).count()).alias(f"{v}__m2"),
+            pl.col(v).min().cast(pl.Float64).alias(f"{v}__min"),
+            pl.col(v).max().cast(pl.Float64).alias(f"{v}__max"),
+        ]
+    out = batch.group_by(by).agg(aggs) if by else batch.select(aggs)
+    for row in out.iter_rows(named = True):
+        key = tuple(row[g] for g in by)
+        for v in variables:
+            if row[f"{v}__n"]:
+                yield key, v, (row[f"{v}__n"], row[f"{v}__mean"], row[f"{v}__m2"] or 0.0,
+                               row[f"{v}__min"], row[f"{v}__max"])
+
+def describe(lf, variables, by = (), batch_size = 500_000, k = 1000, quantiles = (), exact = None):
+    # N / Mean / SD / Min / Median / Max per variable (and group) from one streaming pass;
+    # quantiles are exact up to `exact` values per group, approximate (rank error ~1/k) beyond
+    by = list(by)
+    schema = lf.collect_schema()
+    floats = [v for v in variables if schema[v] in (pl.Float32, pl.Float64)]
+    # NaN counts as missing, as in pandas .agg
+    lf = lf.select(by + list(variables)).with_columns([pl.col(v).fill_nan(None) for v in floats])
+
+    moments, sketches = {}, {}
+    for batch in lf.collect_batches(chunk_size = batch_size):
+        for key, v, m in _batch_moments(batch, variables, by):
+            moments[key, v] = merge_moments(moments.get((key, v), EMPTY_MOMENTS), m)
+
+        parts = batch.partition_by(by, as_dict = True) if by else {(): batch}
+        for key, part in parts.items():
+            for v in variables:
+                values = part[v].drop_nulls().to_numpy()
+                if len(values):
+                    sketch = sketches.setdefault((tuple(key), v), KLLSketch(k = k, seed = len(sketches), exact = exact))
+                    sketch.update(values)
+
+    rows = []
+    for (key, v), (n, mean, m2, lo, hi) in moments.items():
+        sketch = sketches[key, v]
+        row = dict(zip(by, key))
+        row.update({
+            'variable': v,
+            'N': int(n),
+            'Mean': mean,
+            'SD': np.sqrt(m2 / (n - 1)) if n > 1 else np.nan,
+            'Min': lo,
+            'Median': sketch.quantile(0.5),
+            'Max': hi,
+        })
+        for q in quantiles:
+            row[f"p{int(round(q * 100))}"] = sketch.quantile(q)
+        rows.append(row)
+
+    table = pd.DataFrame(rows)
+    if table.empty:
+        return table
+    # variables in the requested order within each group
+    table['variable'] = pd.Categorical(table['variable'], categories = list(variables), ordered = True)
+    table = table.sort_values(by + ['variable'])
+    table['variable'] = table['variable'].astype(str)
+    return table.set_index(by + ['variable'])
@@ -0,0 +1,161 @@
+# Memory-mapped design matrices for the estimators
+# Daman Dhaliwal
+
+# import libraries
+import numpy as np
+import polars as pl
+import os
+import json
+import shutil
+
+from features import SURVIVAL_REQUIRED, spec_hash, survival_lazy, growth_lazy
+from utils import paths
+from profiling import stage
+
+
+def category_levels(lf, columns):
+    # sorted levels of each categorical, from one streaming pass
+    out = lf.select([pl.col(c).drop_nulls().unique().sort().implode() for c in columns]).collect(engine = 'streaming')
+    return {c: np.array(out[c][0].to_list()) for c in columns}
+
+def _fingerprint(path):
+    stat = os.stat(path)
+    return {'path': os.path.basename(path), 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+def _design_dir(name, spec):
+    return os.path.join(paths()['data'], 'design', f"{name}_{spec_hash(spec)}")
+
+def load_design(path):
+    # every array is opened read-only and paged in from disk on demand
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    load = lambda file: np.load(os.path.join(path, f"{file}.npy"), mmap_mode = 'r')
+    return {
+        'X': load('X'),
+        'names': meta['names'],
+        'y': {c: load(f"y_{c}") for c in meta['y_cols']},
+        'codes': {c: load(f"codes_{c}") for c in meta['codes']},
+        'levels': meta['levels'],
+        'nobs': meta['nobs'],
+        'key': meta['key'],
+        'path': path,
+    }
+
+def build_design(name, make_lf, spec, x_cols, y_cols = (), dummies = (), codes = (),
+                 add_const = False, dtype = 'float64', overwrite = False, batch_size = 500_000,
+                 drop_missing = True):
+    # X = x_cols, then drop-first dummies, then the constant; outcomes as float64 vectors
+    # and categoricals as int32 codes into their sorted levels. Written batch by batch
+    # from the lazy frame, so neither pandas nor a second in-memory copy is involved.
+    # With drop_missing=False only rows missing a categorical are dropped and missing
+    # x/y values are stored as NaN, for estimators that pick their own complete cases.
+    x_cols, y_cols, dummies, codes = list(x_cols), list(y_cols), list(dummies), list(codes)
+    spec = {**spec, 'x_cols': x_cols, 'y_cols': y_cols, 'dummies': dummies, 'codes': codes,
+            'add_const': add_const, 'dtype': np.dtype(dtype).str, 'drop_missing': drop_missing}
+    path = _design_dir(name, spec)
+
+    if not overwrite and os.path.exists(os.path.join(path, 'meta.json')):
+        return load_design(path)
+
+    with stage(f"design.{name}", dtype = np.dtype(dtype).name) as record:
+        record['rows'] = _write_design(path, make_lf(), spec, x_cols, y_cols, dummies, codes,
+                                       add_const, dtype, batch_size, drop_missing)
+    return load_design(path)
+
+def _write_design(path, lf, spec, x_cols, y_cols, dummies, codes, add_const, dtype, batch_size, drop_missing):
+    needed = list(dict.fromkeys(x_cols + y_cols + dummies + codes))
+    categorical = list(dict.fromkeys(dummies + codes))
+    lf = lf.select(needed).drop_nulls(subset = None if drop_missing else categorical)
+    if not drop_missing:
+        lf = lf.with_columns([pl.col(c).cast(pl.Float64).fill_null(np.nan) for c in x_cols + y_cols])
+    levels = category_levels(lf, categorical)
+    n = lf.select(pl.len()).collect(engine = 'streaming').item()
+
+    names = x_cols + [f"{c}_{level}" for c in dummies for level in levels[c][1:]]
+    names += ['const'] if add_const else []
+
+    # written to a scratch directory and renamed, so a killed build is never loaded
+    tmp = path + '.tmp'
+    shutil.rmtree(tmp, ignore_errors = True)
+    os.makedirs(tmp)
+    open_npy = lambda file, dt, shape: np.lib.format.open_memmap(os.path.join(tmp, f"{file}.npy"),
+                                                                 mode = 'w+', dtype = dt, shape = shape)
+    X = open_npy('X', dtype, (n, len(names)))
+    ys = {c: open_npy(f"y_{c}", 'float64', (n,)) for c in y_cols}
+    cs = {c: open_npy(f"codes_{c}", 'int32', (n,)) for c in codes}
+
+    start = 0
+    for batch in lf.collect_batches(chunk_size = batch_size):
+        stop = start + batch.height
+        X[start:stop, :len(x_cols)] = batch.select(x_cols).to_numpy()
+        col = len(x_cols)
+        for c in dummies:
+            level = np.searchsorted(levels[c], batch[c].to_numpy())
+            block = X[start:stop, col:col + len(levels[c]) - 1]
+            block[...] = 0
+            rows = np.nonzero(level > 0)[0]
+            block[rows, level[rows] - 1] = 1
+            col += len(levels[c]) - 1
+        if add_const:
+            X[start:stop, -1] = 1
+        for c in y_cols:
+            ys[c][start:stop] = batch[c].to_numpy()
+        for c in codes:
+            cs[c][start:stop] = np.searchsorted(levels[c], batch[c].to_numpy())
+        start = stop
+
+    for arr in [X] + list(ys.values()) + list(cs.values()):
+        arr.flush()
+    del X, ys, cs
+
+    meta = {
+        'names': names,
+        'y_cols': y_cols,
+        'codes': codes,
+        'levels': {c: levels[c].tolist() for c in levels},
+        'nobs': n,
+        'key': spec_hash(spec),
+    }
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump(meta, f, default = str)
+
+    shutil.rmtree(path, ignore_errors = True)
+    os.replace(tmp, path)
+    print(f"Wrote design ({n} x {len(names)}, {np.dtype(dtype).name}) to {path}")
+    return n
+
+
+def survival_design(x_cols, y_cols = (), dummies = (), codes = (), required_cols = SURVIVAL_REQUIRED,
+                    naics4 = False, add_const = False, dtype = 'float64', overwrite = False,
+                    drop_missing = True):
+    # same sample and features as survival_frame, in the same row order
+    source_path = os.path.join(paths()['data'], "survival_merged.parquet")
+    make_lf = lambda: survival_lazy(required_cols = required_cols, naics4 = naics4, overwrite = overwrite)
+    if overwrite or not os.path.exists(source_path):
+        # the source is (re)built now, once, and its frame reused for the design
+        lf = make_lf()
+        make_lf = lambda: lf
+
+    spec = {'sample': 'survival', 'required': list(required_cols), 'naics4': naics4,
+            'source': _fingerprint(source_path)}
+    return build_design('survival', make_lf, spec, x_cols, y_cols, dummies, codes,
+                        add_const = add_const, dtype = dtype, overwrite = overwrite, drop_missing = drop_missing)
+
+def growth_design(x_cols, y_cols = (), dummies = (), codes = (), baseline_year = 2019, outcome_year = 2024,
+                  required_cols = None, survivors_only = True, naics4 = False, add_const = False,
+                  dtype = 'float64', overwrite = False, drop_missing = True):
+    # same sample and features as growth_frame, in the same row order
+    source_path = os.path.join(paths()['data'], "combined_merged.parquet")
+    make_lf = lambda: growth_lazy(baseline_year = baseline_year, outcome_year = outcome_year,
+                                  required_cols = required_cols, survivors_only = survivors_only,
+                                  naics4 = naics4, overwrite = overwrite)
+    if overwrite or not os.path.exists(source_path):
+        # the source is (re)built now, once, and its frame reused for the design
+        lf = make_lf()
+        make_lf = lambda: lf
+
+    spec = {'sample': 'growth', 'baseline_year': baseline_year, 'outcome_year': outcome_year,
+            'required': required_cols, 'survivors_only': survivors_only, 'naics4': naics4,
+            'source': _fingerprint(source_path)}
+    return build_design('growth', make_lf, spec, x_cols, y_cols, dummies, codes,
+                        add_const = add_const, dtype = dtype, overwrite = overwrite, drop_missing = drop_missing)
@@ -5,57 +5,63 @@
 import pandas as pd
 import doubleml as dml
 import numpy as np
-from xgboost import XGBRegressor, XGBClassifier
+from scipy import stats
 import os
-
-from data_prep import merged_survival
-from utils import paths
-
-def run_dml_survival(overwrite = False):
-    data = merged_survival(overwrite = overwrite)
-
-    data = data.to_pandas()
-
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from features import survival_frame
+from design import survival_design
+from checkpoint import frame_hash, checkpoint_path, load_checkpoint, append_checkpoint
+from nuisance import sample_splits, cross_fit
+from learners import make_classifier, make_regressor, categorical_controls
+from utils import paths, available_cores
+from profiling import timed, stage
+
+def survival_controls(required_cols, numeric, categorical = False, naics4 = False, overwrite = False):
+    # nuisance design: state as one native categorical column, or the usual state dummies
+    if categorical:
+        data = survival_frame(required_cols = required_cols, naics4 = naics4, overwrite = overwrite)
+        return data, categorical_controls(data, numeric, ['state'])
+
+    data = survival_frame(required_cols = required_cols, dummies = ['state'], naics4 = naics4, overwrite = overwrite)
+    x_cols = list(numeric) + [c for c in data.columns if c.startswith('state_')]
+    x_cols = [c for c in x_cols if data[c].nunique() > 1]
+    return data, data[x_cols]
+
+@timed(rows = None)
+def run_dml_survival(overwrite = False, seed = 42, categorical = False, batch_size = None):
+    # standardized social capital, logged size and state dummies (cached)
     required_cols = ['survived_2024', 'ec', 'employees', 'sales', 'fips', 'clustering', 'civic']
-    initial_len = len(data)
-    data = data.dropna(subset=required_cols)
-    print(f"Dropped {initial_len - len(data)} rows due to missing required columns.")
+    data, X = survival_controls(required_cols, ['log_employees'], categorical = categorical, overwrite = overwrite)
 
-    data = data.drop('firm_age', axis = 1)
+    social_capital = ['ec_std', 'clustering_std', 'civic_std']
 
-    # standardize all continuous variables - employees, sales, ec, clustering, civic
-    data['ec_std'] = (data['ec'] - data['ec'].mean()) / data['ec'].std()
-    data['clustering_std'] = (data['clustering'] - data['clustering'].mean()) / data['clustering'].std()
-    data['civic_std'] = (data['civic'] - data['civic'].mean()) / data['civic'].std()
-    data['log_employees'] = np.log1p(data['employees'])
-    data['log_sales'] = np.log1p(data['sales'])
-    data['state'] = data['fips'].str[:2]
+    # define learners
+    ml_l = make_classifier()
+    ml_m = make_regressor()
 
-    # create dummies for controls (state only)
-    data = pd.get_dummies(data, columns = ['state'], drop_first = True)
-
-    social_capital = ['ec_std', 'clustering_std', 'civic_std']
+    # the outcome nuisance E[Y|X] does not depend on the treatment: cross-fit it once
+    # on one shared split and hand the cached predictions to every PLR fit
+    splits = sample_splits(len(data), n_folds = 5, seed = seed)
+    l_hat = cross_fit(ml_l, X, data['survived_2024'], splits, overwrite = overwrite, batch_size = batch_size)
 
     results = []
 
     for sc in social_capital:
-        valid_cols = ['log_employees'] + [c for c in data.columns if c.startswith('state_')]
-        valid_cols = [c for c in valid_cols if data[c].nunique() > 1]
+        m_hat = cross_fit(ml_m, X, data[sc], splits, overwrite = overwrite, batch_size = batch_size)
 
-        # setup DoubleML
+        # setup DoubleML (it only uses the supplied predictions, so numeric x_cols suffice)
         dml_data = dml.DoubleMLData(
             data,
             y_col = 'survived_2024',
             d_cols = sc,
-            x_cols = valid_cols
+            x_cols = [c for c in X.columns if c in data.columns and X[c].dtype != 'category']
         )
 
-        # define learners
-        ml_l = XGBClassifier(n_estimators = 200, max_depth = 3, learning_rate = 0.1, n_jobs = -1, random_state = 42, use_label_encoder = False, eval_metric = 'logloss')
-        ml_m = XGBRegressor(n_estimators = 200, max_depth = 3, learning_rate = 0.1, n_jobs = -1, random_state = 42)
-
-        dml_model = dml.DoubleMLPLR(dml_data, ml_l, ml_m, n_folds = 5)
-        dml_model.fit()
+        dml_model = dml.DoubleMLPLR(dml_data, ml_l, ml_m, n_folds = 5, draw_sample_splitting = False)
+        dml_model.set_sample_splitting([splits])
+        dml_model.fit(external_predictions = {sc: {'ml_l': l_hat.reshape(-1, 1), 'ml_m': m_hat.reshape(-1, 1)}})
 
         coef = dml_model.coef[0]
         pval = dml_model.pval[0]
@@ -71,76 +77,300 @@ def run_dml_survival(overwrite = False):
     return results_df
     
 
-def run_industry_dml(overwrite = False):
-    data = merged_survival(overwrite = overwrite)
-
-    data = data.to_pandas()
-
-    required_cols = ['survived_2024', 'ec', 'employees', 'sales', 'fips']
-    initial_len = len(data)
-    data = data.dropna(subset=required_cols)
-    print(f"Dropped {initial_len - len(data)} rows due to missing required columns.")
+@timed(rows = None)
+def run_dml_joint(overwrite = False, seed = 42, categorical = False, batch_size = None, mmap = False):
+    # all social capital treatments in one partially linear model
+    # Y = D'theta + g(X) + e, with one split, one outcome nuisance and one m(X) per treatment
+    required_cols = ['survived_2024', 'ec', 'employees', 'sales', 'fips', 'clustering', 'civic']
+    social_capital = ['ec_std', 'clustering_std', 'civic_std']
 
-    data = data.drop('firm_age', axis = 1)
+    if mmap:
+        # float32 controls (what xgboost bins anyway) memory-mapped from disk; with
+        # batch_size set, xgboost reads them batch by batch and never holds a dense copy
+        if categorical:
+            raise ValueError("mmap designs hold numeric controls only; use categorical=False")
+        design = survival_design(['log_employees'], y_cols = ['survived_2024'] + social_capital,
+                                 dummies = ['state'], required_cols = required_cols,
+                                 dtype = 'float32', overwrite = overwrite)
+        X = design['X']
+        data = pd.DataFrame({c: design['y'][c] for c in design['y']})
+    else:
+        data, X = survival_controls(required_cols, ['log_employees'], categorical = categorical, overwrite = overwrite)
+
+    # define learners
+    ml_l = make_classifier()
+    ml_m = make_regressor()
+
+    # same split and cache as run_dml_survival, so either one reuses the other's nuisances
+    splits = sample_splits(len(data), n_folds = 5, seed = seed)
+    l_hat = cross_fit(ml_l, X, data['survived_2024'], splits, overwrite = overwrite, batch_size = batch_size)
+    m_hat = np.column_stack([
+        cross_fit(ml_m, X, data[sc], splits, overwrite = overwrite, batch_size = batch_size) for sc in social_capital
+    ])
+
+    # residualize, then solve the orthogonal moment E[(Y~ - D~'theta) D~] = 0 jointly
+    y_res = data['survived_2024'].to_numpy(dtype = float) - l_hat
+    d_res = data[social_capital].to_numpy(dtype = float) - m_hat
+    n_obs = len(y_res)
+
+    J = d_res.T @ d_res / n_obs
+    theta = np.linalg.solve(J, d_res.T @ y_res / n_obs)
+
+    # sandwich covariance of the stacked scores
+    psi = d_res * (y_res - d_res @ theta)[:, None]
+    omega = psi.T @ psi / n_obs
+    J_inv = np.linalg.inv(J)
+    vcov = J_inv @ omega @ J_inv / n_obs
+
+    se = np.sqrt(np.diag(vcov))
+    pval = 2 * stats.norm.sf(np.abs(theta / se))
+
+    results_df = pd.DataFrame({
+        'social_capital': social_capital,
+        'coef': theta,
+        'se': se,
+        'pval': pval,
+        'signficant': ['***' if p < 0.01 else '**' if p < 0.05 else '*' if p < 0.1 else 'n.s.' for p in pval],
+    })
+    vcov_df = pd.DataFrame(vcov, index = social_capital, columns = social_capital)
+
+    # joint Wald test that all three effects are zero
+    wald = float(theta @ np.linalg.solve(vcov, theta))
+    wald_p = stats.chi2.sf(wald, df = len(theta))
 
-    # standardize all continuous variables - employees, sales, ec, clustering, civic
-    data['ec_std'] = (data['ec'] - data['ec'].mean()) / data['ec'].std()
-    data['clustering_std'] = (data['clustering'] - data['clustering'].mean()) / data['clustering'].std()
-    data['civic_std'] = (data['civic'] - data['civic'].mean()) / data['civic'].std()
-    data['log_employees'] = np.log1p(data['employees'])
-    data['log_sales'] = np.log1p(data['sales'])
-    data['state'] = data['fips'].str[:2]
+    print(results_df)
+    print(vcov_df)
+    print(f"Joint Wald test: chi2({len(theta)}) = {wald:.3f}, p = {wald_p:.4f}")
 
-    # create dummies for controls (state only)
-    data = pd.get_dummies(data, columns = ['state'], drop_first = True)
+    path = paths()['data']
+    results_df.to_csv(os.path.join(path, 'dml_joint_results.csv'), index = False)
+    vcov_df.to_csv(os.path.join(path, 'dml_joint_vcov.csv'))
+
+    return results_df, vcov_df
+
+# employee size classes for heterogeneity cuts (zero-employee firms fall in the first)
+SIZE_BINS = [0, 4, 9, 19, 49, 99, np.inf]
+SIZE_LABELS = ['0-4', '5-9', '10-19', '20-49', '50-99', '100+']
+
+def gate_from_residuals(y_res, d_res, groups):
+    # group average effects from the full-sample orthogonal scores:
+    # theta_g solves sum_g (Y~ - theta_g D~) D~ = 0, with its own sandwich variance
+    frame = pd.DataFrame({'g': groups, 'dy': d_res * y_res, 'dd': d_res ** 2})
+    sums = frame.groupby('g', observed = True).agg(n = ('dd', 'size'), dy = ('dy', 'sum'), dd = ('dd', 'sum'))
+    theta = sums['dy'] / sums['dd']
+
+    psi = d_res * (y_res - theta.reindex(groups).to_numpy() * d_res)
+    psi2 = pd.Series(psi ** 2).groupby(np.asarray(groups)).sum()
+
+    out = pd.DataFrame({'n': sums['n'], 'coef': theta, 'se': np.sqrt(psi2.reindex(sums.index)) / sums['dd']})
+    out['pval'] = 2 * stats.norm.sf(np.abs(out['coef'] / out['se']))
+    out['signficant'] = ['***' if p < 0.01 else '**' if p < 0.05 else '*' if p < 0.1 else 'n.s.' for p in out['pval']]
+    return out
+
+@timed(rows = None)
+def run_gate_dml(groupings = ('naics2', 'naics4', 'state', 'size_bin'), d_col = 'clustering_std',
+                 min_size = 2, overwrite = False, seed = 42, categorical = False, batch_size = None):
+    # one full-sample cross-fit, then GATEs for any grouping as a vectorized group-by
+    required_cols = ['survived_2024', 'ec', 'employees', 'sales', 'fips']
+    # the treatment's raw column too, or counties without it become NaN labels for ml_m
+    raw_d = d_col[:-len('_std')] if d_col.endswith('_std') else d_col
+    required_cols += [raw_d] if raw_d not in required_cols else []
+    numeric = [c for c in ['log_employees', 'ec_std', 'civic_std', 'naics_code'] if c != d_col]
+
+    if categorical:
+        # state and 4 digit industry as native categorical splits
+        data = survival_frame(required_cols = required_cols, naics4 = True, overwrite = overwrite)
+        data['naics_code'] = pd.to_numeric(data['naics'], errors = 'coerce')
+        X = categorical_controls(data, numeric, ['state', 'naics4'])
+    else:
+        data = survival_frame(required_cols = required_cols, dummies = ['state'], naics4 = True, overwrite = overwrite)
+        # numeric naics code lets the trees carve out 2 and 4 digit industries
+        data['naics_code'] = pd.to_numeric(data['naics'], errors = 'coerce')
+        x_cols = numeric + [c for c in data.columns if c.startswith('state_')]
+        X = data[[c for c in x_cols if data[c].nunique() > 1]]
+
+    data['state'] = data['fips'].astype(str).str[:2]
+    data['size_bin'] = pd.cut(data['employees'], bins = SIZE_BINS, labels = SIZE_LABELS, include_lowest = True)
+
+    # define learners
+    ml_l = make_classifier()
+    ml_m = make_regressor()
+
+    splits = sample_splits(len(data), n_folds = 5, seed = seed)
+    l_hat = cross_fit(ml_l, X, data['survived_2024'], splits, overwrite = overwrite, batch_size = batch_size)
+    m_hat = cross_fit(ml_m, X, data[d_col], splits, overwrite = overwrite, batch_size = batch_size)
+
+    y_res = data['survived_2024'].to_numpy(dtype = float) - l_hat
+    d_res = data[d_col].to_numpy(dtype = float) - m_hat
 
-    industries = data['naics2'].unique()
+    path = paths()['data']
+    results = {}
+
+    for grouping in groupings:
+        # rows without a group are left out rather than pooled into a 'nan' group
+        keys = data[grouping]
+        valid = keys.notna().to_numpy()
+        if not valid.all():
+            print(f"{grouping}: {(~valid).sum()} rows without a group left out")
+        gate = gate_from_residuals(y_res[valid], d_res[valid], keys[valid].astype(str).to_numpy())
+        gate = gate[gate['n'] >= min_size].rename_axis(grouping).reset_index()
+        gate = gate.sort_values('coef', ascending = False)
+
+        print(gate)
+        gate.to_csv(os.path.join(path, f'dml_gate_{grouping}.csv'), index = False)
+        results[grouping] = gate
+
+    return results
+
+# fit one PLR inside a single group (runs in a worker process)
+def _fit_group_dml(key, df, label, y_col, d_col, x_cols, n_jobs, seed = 42, categorical = (), batch_size = None):
+    # DoubleML draws its fold split from the global numpy state
+    np.random.seed(seed)
+
+    valid_cols = [c for c in x_cols if df[c].nunique() > 1]
+
+    # setup DoubleML
+    dml_data = dml.DoubleMLData(
+        df,
+        y_col = y_col,
+        d_cols = d_col,
+        x_cols = valid_cols
+    )
+
+    # define learners
+    ml_l = make_classifier(n_jobs = n_jobs)
+    ml_m = make_regressor(n_jobs = n_jobs)
+
+    with stage('dml.group', group = str(key), label = label, d_col = d_col) as record:
+        record['rows'] = len(df)
+        if categorical or batch_size is not None:
+            # native categorical splits and/or batched quantized matrices: the nuisances are
+            # cross-fit here, as in run_dml_survival, and handed to DoubleML
+            X = categorical_controls(df, valid_cols, categorical) if categorical else df[valid_cols]
+            splits = sample_splits(len(df), n_folds = 5, seed = seed)
+            l_hat = cross_fit(ml_l, X, df[y_col], splits, batch_size = batch_size)
+            m_hat = cross_fit(ml_m, X, df[d_col], splits, batch_size = batch_size)
+
+            dml_model = dml.DoubleMLPLR(dml_data, ml_l, ml_m, n_folds = 5, draw_sample_splitting = False)
+            dml_model.set_sample_splitting([splits])
+            dml_model.fit(external_predictions = {d_col: {'ml_l': l_hat.reshape(-1, 1), 'ml_m': m_hat.reshape(-1, 1)}})
+        else:
+            dml_model = dml.DoubleMLPLR(dml_data, ml_l, ml_m, n_folds = 5)
+            dml_model.fit()
+
+    coef = dml_model.coef[0]
+    pval = dml_model.pval[0]
+
+    return {
+        label: key,
+        'n': len(df),
+        'coef': coef,
+        'pval': pval,
+        'signficant': '***' if pval < 0.01 else '**' if pval < 0.05 else '*' if pval < 0.1 else 'n.s.'
+    }
+
+@timed(rows = None)
+def run_group_dml(data, group_col, x_cols, filename, min_size, label = None,
+                  y_col = 'survived_2024', d_col = 'clustering_std',
+                  workers = None, cores_per_fit = 1, resume = True, seed = 42,
+                  categorical = (), batch_size = None):
+    # categorical names columns (e.g. ['state']) passed to the learners as native
+    # categoricals instead of dummies in x_cols; batch_size trains them batch by batch
+    label = label or group_col
+    categorical = list(categorical)
+
+    # partition once instead of boolean-masking the full frame per group
+    cols = list(dict.fromkeys([group_col, y_col, d_col] + list(x_cols) + categorical))
+    groups = [
+        (key, df) for key, df in data[cols].groupby(group_col, sort = False)
+        if len(df) >= min_size
+    ]
+
+    # groups already finished under this spec and seed are read back, not refit
+    spec = {
+        'group_col': group_col, 'label': label, 'y_col': y_col, 'd_col': d_col,
+        'x_cols': list(x_cols), 'min_size': min_size, 'data': frame_hash(data[cols]),
+        'categorical': categorical, 'batch_size': batch_size,
+    }
+    ckpt = checkpoint_path(os.path.splitext(os.path.basename(filename))[0], spec, seed)
+    done = load_checkpoint(ckpt, resume = resume)
+    if done:
+        print(f"Resuming: {len(done)} groups already in {ckpt}")
+
+    # split cores between concurrent fits instead of every learner taking all of them
+    cores = available_cores()
+    workers = workers or max(1, cores // cores_per_fit)
+    print(f"Fitting {len(groups)} {group_col} groups on {workers} workers x {cores_per_fit} cores")
 
     results = []
 
-    for ind in industries:
-        df = data[data['naics2'] == ind].copy()
-
-        if len(df) < 1000:
-            continue
-
-        print(ind, len(df))
-
-        # keep only state dummies and employees as controls
-        valid_cols = ['log_employees', 'ec_std', 'civic_std'] + [c for c in df.columns if c.startswith('state_')]
-        valid_cols = [c for c in valid_cols if df[c].nunique() > 1]
-
-        # setup DoubleML
-        dml_data = dml.DoubleMLData(
-            df,
-            y_col = 'survived_2024',
-            d_cols = 'clustering_std',
-            x_cols = valid_cols
-        )
-
-        # define learners
-        ml_l = XGBClassifier(n_estimators = 200, max_depth = 3, learning_rate = 0.1, n_jobs = -1, random_state = 42, use_label_encoder = False, eval_metric = 'logloss')
-        ml_m = XGBRegressor(n_estimators = 200, max_depth = 3, learning_rate = 0.1, n_jobs = -1, random_state = 42)
-
-        dml_model = dml.DoubleMLPLR(dml_data, ml_l, ml_m, n_folds = 5)
-        dml_model.fit()
+    # stream rows to the csv as groups finish
+    with open(filename, 'w', newline = '') as f:
+        header = True
+
+        def record(result, key = None):
+            nonlocal header
+            print(result[label], result['n'])
+            if key is not None:
+                append_checkpoint(ckpt, key, result)
+            results.append(result)
+            pd.DataFrame([result]).to_csv(f, index = False, header = header)
+            f.flush()
+            header = False
+
+        for key, _ in groups:
+            if str(key) in done:
+                record(done[str(key)])
+        todo = [(key, df) for key, df in groups if str(key) not in done]
+
+        if workers == 1:
+            for key, df in todo:
+                record(_fit_group_dml(key, df.drop(columns = group_col), label, y_col, d_col, x_cols, cores_per_fit, seed,
+                                      categorical, batch_size), key)
+        else:
+            # spawn, since xgboost/openmp are not fork-safe
+            ctx = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(max_workers = workers, mp_context = ctx) as pool:
+                futures = {
+                    pool.submit(_fit_group_dml, key, df.drop(columns = group_col), label, y_col, d_col, x_cols, cores_per_fit, seed,
+                                categorical, batch_size): key
+                    for key, df in todo
+                }
+                for future in as_completed(futures):
+                    record(future.result(), futures[future])
+
+    # rewrite sorted once everything is in
+    results_df = pd.DataFrame(results).sort_values('coef', ascending=False)
+    results_df.to_csv(filename, index=False)
+    return results_df
 
-        coef = dml_model.coef[0]
-        pval = dml_model.pval[0]
 
-        results.append({
-            'naics2': ind,
-            'n': len(df),
-            'coef': coef,
-            'pval': pval,
-            'signficant': '***' if pval < 0.01 else '**' if pval < 0.05 else '*' if pval < 0.1 else 'n.s.'
-        })
+@timed(rows = None)
+def run_industry_dml(overwrite = False, workers = None, cores_per_fit = 1, resume = True,
+                     categorical = False, batch_size = None):
+    # standardized social capital, logged size and state (dummies, or one categorical) (cached)
+    required_cols = ['survived_2024', 'ec', 'employees', 'sales', 'fips']
+    data = survival_frame(required_cols = required_cols, dummies = [] if categorical else ['state'], overwrite = overwrite)
 
-    results_df = pd.DataFrame(results).sort_values('coef', ascending=False)
-    print(results_df)
     path = paths()['data']
     filename = os.path.join(path, 'dml_industry_results.csv')
-    results_df.to_csv(filename, index=False)
+
+    # keep only state and employees as controls
+    x_cols = ['log_employees', 'ec_std', 'civic_std'] + [c for c in data.columns if c.startswith('state_')]
+
+    results_df = run_group_dml(
+        data,
+        group_col = 'naics2',
+        x_cols = x_cols,
+        filename = filename,
+        min_size = 1000,
+        workers = workers,
+        cores_per_fit = cores_per_fit,
+        resume = resume,
+        categorical = ['state'] if categorical else (),
+        batch_size = batch_size,
+    )
+    print(results_df)
     return results_df
 
 if __name__ == "__main__":
@@ -8,19 +8,14 @@ import dowhy
 from dowhy import CausalModel
 
 # Import your data loader
-from data_prep import merged_survival
+from features import survival_frame
+from profiling import timed
 
+@timed(rows = None)
 def run_dowhy_robustness(overwrite = False):
-    df = merged_survival(overwrite = overwrite)
-    
-    pdf = df.to_pandas()
-
+    # Standardize & Prep (cached)
     subset_cols = ['survived_2022', 'ec', 'employees', 'naics2', 'fips', 'firm_age']
-    pdf = pdf.dropna(subset=subset_cols)
-
-    # Standardize & Prep
-    pdf['ec_std'] = (pdf['ec'] - pdf['ec'].mean()) / pdf['ec'].std()
-    pdf['state'] = pdf['fips'].str[:2]
+    pdf = survival_frame(required_cols = subset_cols, overwrite = overwrite)
     
     model = CausalModel(
         data=pdf,
@@ -0,0 +1,230 @@
+# OLS with absorbed fixed effects and county-clustered standard errors
+# Daman Dhaliwal
+
+# import libraries
+import pandas as pd
+import numpy as np
+import re
+from scipy import stats
+
+FE_TERM = re.compile(r'^C\((\w+)\)$')
+
+
+def parse_formula(formula):
+    # "y ~ x1 + x2 + C(state) + C(naics2)" -> ('y', ['x1', 'x2'], ['state', 'naics2'])
+    lhs, rhs = formula.split('~')
+    regressors, fixed_effects = [], []
+    for term in rhs.split('+'):
+        term = term.strip()
+        match = FE_TERM.match(term)
+        if match:
+            fixed_effects.append(match.group(1))
+        elif re.match(r'^\w+$', term):
+            regressors.append(term)
+        else:
+            raise ValueError(f"Unsupported term in formula: {term}")
+    return lhs.strip(), regressors, fixed_effects
+
+def fe_codes(data, fixed_effects):
+    return [pd.factorize(data[fe])[0] for fe in fixed_effects]
+
+def demean(M, codes, tol = 1e-10, max_iter = 1000, copy = True):
+    # alternating projections: sweep out each set of group means until nothing moves;
+    # one fixed effect converges in a single sweep (in place when copy=False)
+    M = np.array(M, dtype = float) if copy else np.asarray(M, dtype = float)
+    counts = [np.bincount(c) for c in codes]
+    if not codes:
+        return M - M.mean(axis = 0)
+
+    for _ in range(max_iter if len(codes) > 1 else 1):
+        shift = 0.0
+        for c, n in zip(codes, counts):
+            for j in range(M.shape[1]):
+                means = np.bincount(c, weights = M[:, j]) / n
+                M[:, j] -= means[c]
+                shift = max(shift, np.abs(means).max())
+        if shift < tol:
+            break
+    return M
+
+def cluster_vcov(X, resid, clusters, bread, k_params):
+    # sandwich with the meat built from per-cluster score sums, small-sample corrected
+    # as statsmodels' cov_type='cluster': G/(G-1) * (n-1)/(n-k)
+    g = pd.factorize(clusters)[0]
+    n_clusters = g.max() + 1
+    scores = X * resid[:, None]
+    sums = np.column_stack([np.bincount(g, weights = scores[:, j], minlength = n_clusters)
+                            for j in range(X.shape[1])])
+    meat = sums.T @ sums
+    n = len(resid)
+    correction = n_clusters / (n_clusters - 1) * (n - 1) / (n - k_params)
+    return correction * bread @ meat @ bread, n_clusters
+
+def fe_dof(codes):
+    # absorbed parameters as a dense fit would count them: intercept plus L-1 dummies per effect
+    return 1 + sum(int(c.max()) for c in codes)
+
+def centered_ss(M):
+    return ((M - M.mean(axis = 0)) ** 2).sum(axis = 0)
+
+def absorbed_columns(raw_ss, demeaned, tol = 1e-8):
+    # regressors the fixed effects explain completely (e.g. a county variable under C(fips)),
+    # given their centered sums of squares before demeaning
+    return (demeaned ** 2).sum(axis = 0) <= tol * np.maximum(raw_ss, 1e-300)
+
+def fit_demeaned(y_dm, X_dm, names, clusters, k_absorbed, y = None):
+    bread = np.linalg.pinv(X_dm.T @ X_dm)
+    beta = bread @ (X_dm.T @ y_dm)
+    resid = y_dm - X_dm @ beta
+
+    vcov, n_clusters = cluster_vcov(X_dm, resid, clusters, bread, len(names) + k_absorbed)
+    bse = np.sqrt(np.diag(vcov))
+    # statsmodels reports normal p-values for clustered covariance
+    pvalues = 2 * stats.norm.sf(np.abs(beta / bse))
+
+    ssr = resid @ resid
+    result = {
+        'params': pd.Series(beta, index = names),
+        'bse': pd.Series(bse, index = names),
+        'pvalues': pd.Series(pvalues, index = names),
+        'vcov': pd.DataFrame(vcov, index = names, columns = names),
+        'nobs': len(resid),
+        'n_clusters': n_clusters,
+        'r2_within': 1 - ssr / (y_dm @ y_dm),
+    }
+    if y is not None:
+        result['r2'] = 1 - ssr / np.sum((y - y.mean()) ** 2)
+    return result
+
+def _fit_columns(y, M, regressors, cols, clusters, k_absorbed, raw_ss):
+    # fit one variant from a subset of the already demeaned regressor columns
+    idx = [regressors.index(c) for c in cols]
+    dropped = np.array([absorbed_columns(raw_ss[i], M[:, 1 + i]) for i in idx], dtype = bool)
+    if dropped.any():
+        print(f"Omitted (collinear with fixed effects): {', '.join(np.array(cols)[dropped])}")
+    keep = [c for c, d in zip(cols, dropped) if not d]
+    keep_idx = [i for i, d in zip(idx, dropped) if not d]
+    # a variant using every column in order fits from a view, not a copy
+    X_dm = M[:, 1:] if keep_idx == list(range(len(regressors))) else M[:, 1:][:, keep_idx]
+
+    result = fit_demeaned(M[:, 0], X_dm, keep, clusters, k_absorbed, y = y)
+    for key in ['params', 'bse', 'pvalues']:
+        result[key] = result[key].reindex(cols)
+    return result
+
+def _parse_batch(formulas):
+    parsed = [parse_formula(f) for f in formulas]
+    y_col, _, fixed_effects = parsed[0]
+    for dep, _, fes in parsed:
+        if dep != y_col or fes != fixed_effects:
+            raise ValueError("Batch formulas must share the dependent variable and fixed effects")
+    return parsed
+
+def fit_fe_batch(formulas, data, cluster = 'fips', tol = 1e-10):
+    # variants sharing a dependent variable and fixed effects; each keeps its own complete
+    # cases, and variants with the same complete cases are demeaned together
+    parsed = _parse_batch(formulas)
+    y_col, _, fixed_effects = parsed[0]
+
+    regressors = list(dict.fromkeys(r for _, regs, _ in parsed for r in regs))
+    data = data.dropna(subset = fixed_effects + [cluster])
+
+    columns = {c: data[c].to_numpy(dtype = float) for c in [y_col] + regressors}
+    return _fit_batch(formulas, parsed, columns, fe_codes(data, fixed_effects), data[cluster].values, tol)
+
+def fit_fe_design(formulas, design, cluster = 'fips', tol = 1e-10):
+    # same fits from a memory-mapped design (design.py): regressors are read from the
+    # X columns and fixed effects and clusters from the stored integer codes
+    parsed = _parse_batch(formulas)
+    y_col, _, fixed_effects = parsed[0]
+    regressors = list(dict.fromkeys(r for _, regs, _ in parsed for r in regs))
+
+    columns = {r: design['X'][:, design['names'].index(r)] for r in regressors}
+    columns[y_col] = design['y'][y_col]
+    codes = [design['codes'][fe] for fe in fixed_effects]
+    return _fit_batch(formulas, parsed, columns, codes, design['codes'][cluster], tol)
+
+def _fit_batch(formulas, parsed, columns, codes, clusters, tol):
+    y_col, _, fixed_effects = parsed[0]
+    n = len(clusters)
+
+    # complete cases of each variant, as a per-formula fit would drop them
+    samples = {}
+    for i, (_, regs, _) in enumerate(parsed):
+        mask = np.ones(n, dtype = bool)
+        for c in [y_col] + regs:
+            mask &= ~np.isnan(columns[c])
+        samples.setdefault(mask.tobytes(), (mask, []))[1].append(i)
+
+    results = [None] * len(formulas)
+    for mask, members in samples.values():
+        rows = None if mask.all() else np.nonzero(mask)[0]
+        take = (lambda a: a) if rows is None else (lambda a: a[rows])
+        regressors = list(dict.fromkeys(r for i in members for r in parsed[i][1]))
+
+        # the one working copy: [y, X] for this sample, demeaned in place
+        y = take(columns[y_col])
+        M = np.empty((len(y), len(regressors) + 1))
+        M[:, 0] = y
+        for j, r in enumerate(regressors):
+            M[:, j + 1] = take(columns[r])
+        raw_ss = np.array([centered_ss(M[:, j]) for j in range(1, M.shape[1])])
+        # levels missing from the subsample are dropped so the codes stay contiguous
+        sample_codes = codes if rows is None else [pd.factorize(c[rows])[0] for c in codes]
+        M = demean(M, sample_codes, tol = tol, copy = False)
+        k_absorbed = fe_dof(sample_codes)
+
+        for i in members:
+            result = _fit_columns(y, M, regressors, parsed[i][1], take(clusters), k_absorbed, raw_ss)
+            result.update({'formula': formulas[i], 'dep_var': y_col, 'fixed_effects': fixed_effects})
+            results[i] = result
+    return results
+
+def fit_fe_ols(formula, data, cluster = 'fips', tol = 1e-10):
+    return fit_fe_batch([formula], data, cluster = cluster, tol = tol)[0]
+
+def regression_table(results, names = None):
+    # one column per model: coefficient with stars, standard error in parentheses below
+    names = names or [f"({i + 1})" for i in range(len(results))]
+    regressors = list(dict.fromkeys(r for res in results for r in res['params'].index))
+
+    rows = {}
+    for reg in regressors:
+        coefs, ses = [], []
+        for res in results:
+            if reg not in res['params'].index or np.isnan(res['params'][reg]):
+                coefs.append('')
+                ses.append('')
+                continue
+            pval = res['pvalues'][reg]
+            sig = '***' if pval < 0.01 else '**' if pval < 0.05 else '*' if pval < 0.1 else ''
+            coefs.append(f"{res['params'][reg]:.4f}{sig}")
+            ses.append(f"({res['bse'][reg]:.4f})")
+        rows[reg] = coefs
+        rows[f"{reg}_se"] = ses
+
+    rows['Fixed effects'] = [', '.join(res['fixed_effects']) for res in results]
+    rows['Observations'] = [res['nobs'] for res in results]
+    rows['Clusters'] = [res['n_clusters'] for res in results]
+    rows['R-squared'] = [f"{res['r2']:.4f}" for res in results]
+    rows['Within R-squared'] = [f"{res['r2_within']:.4f}" for res in results]
+
+    return pd.DataFrame(rows, index = names).T
+
+def print_summary(result):
+    print(f"\nDep. Variable: {result['dep_var']}    Obs: {result['nobs']}    Clusters: {result['n_clusters']}")
+    fit = f"R-squared: {result.get('r2', np.nan):.4f}"
+    if 'r2_within' in result:
+        fit += f"    Within R-squared: {result['r2_within']:.4f}"
+    print(f"Fixed effects: {', '.join(result['fixed_effects']) or 'none'}    {fit}")
+    print(f"   {'':<20} {'coef':>12} {'std err':>12} {'P>|z|':>10}")
+    for name in result['params'].index:
+        # dummy coefficients from a dense fit are summarised by the fixed effects line
+        if name.startswith('C('):
+            continue
+        pval = result['pvalues'][name]
+        if np.isnan(pval):
+            print(f"   {name:<20} {'(omitted)':>12}")
+            continue
+        sig = '***' if pval < 0.01 else '**' if pval < 0.05 else '*' if pval < 0.1 else ''
+        print(f"   {name:<20} {result['params'][name]:>12.4f} {result['bse'][name]:>12.4f} {pval:>10.4f} {sig:>5}")
@@ -0,0 +1,213 @@
+# Shared feature engineering for the estimators
+# Daman Dhaliwal
+
+# import libraries
+import polars as pl
+import os
+import json
+import hashlib
+
+from data_prep import merged_survival, ensure_panel_dataset, growth_panel, growth_panels, code_columns
+from utils import paths
+from profiling import stage
+
+SOCIAL_CAPITAL = ['ec', 'clustering', 'civic']
+
+SURVIVAL_REQUIRED = ['survived_2024', 'ec', 'employees', 'sales', 'fips']
+
+
+def _source_fingerprint(path):
+    stat = os.stat(path)
+    return {'path': os.path.basename(path), 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+# cache key: the frame spec plus the fingerprint of the parquet it was built from
+def spec_hash(spec):
+    payload = json.dumps(spec, sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode()).hexdigest()[:12]
+
+def _cache_path(kind, spec):
+    feature_dir = os.path.join(paths()['data'], 'features')
+    os.makedirs(feature_dir, exist_ok=True)
+    return os.path.join(feature_dir, f"{kind}_{spec_hash(spec)}.parquet")
+
+def _drop_missing(lf, required):
+    schema = lf.collect_schema()
+    # pandas dropna treats NaN as missing, polars does not
+    floats = [c for c in required if schema[c] in (pl.Float32, pl.Float64)]
+    return lf.with_columns([pl.col(c).fill_nan(None) for c in floats]).drop_nulls(subset=required)
+
+def _standardize(lf, moments = None):
+    if moments is None:
+        return lf.with_columns([
+            ((pl.col(c) - pl.col(c).mean()) / pl.col(c).std()).alias(f"{c}_std")
+            for c in SOCIAL_CAPITAL
+        ])
+    # precomputed sample moments keep the streaming plan free of whole-frame aggregations
+    return lf.with_columns([
+        ((pl.col(c) - moments[f"{c}_mean"]) / moments[f"{c}_sd"]).alias(f"{c}_std")
+        for c in SOCIAL_CAPITAL
+    ])
+
+def _moments(lf):
+    return lf.select(
+        [pl.col(c).mean().alias(f"{c}_mean") for c in SOCIAL_CAPITAL] +
+        [pl.col(c).std().alias(f"{c}_sd") for c in SOCIAL_CAPITAL]
+    ).collect(engine = 'streaming').row(0, named = True)
+
+def _codes(lf, naics4 = False):
+    # state/naics2(/naics4) precomputed by compact_schema are reused; older files get them
+    # sliced out of fips/naics here
+    codes = ['state', 'naics2'] + (['naics4'] if naics4 else [])
+    return lf.with_columns([expr.alias(c) for c, expr in code_columns(lf.collect_schema().names(), codes).items()])
+
+def _dummies(df, columns):
+    # same layout as pd.get_dummies(drop_first=True): sorted levels, first one dropped
+    for col in columns:
+        levels = sorted(df[col].drop_nulls().unique().to_list())
+        df = df.with_columns([
+            (pl.col(col) == level).fill_null(False).alias(f"{col}_{level}") for level in levels[1:]
+        ]).drop(col)
+    return df
+
+def _load_or_build(kind, spec, build, overwrite):
+    output_path = _cache_path(kind, spec)
+    cached = not overwrite and os.path.exists(output_path)
+
+    with stage(f"features.{kind}", cached = cached) as record:
+        if cached:
+            df = pl.read_parquet(output_path)
+        else:
+            df = build()
+            df.write_parquet(output_path)
+        df = df.to_pandas()
+        # compact categoricals with sorted levels, so formulas keep the string reference level
+        for col in df.select_dtypes('category'):
+            df[col] = df[col].cat.set_categories(sorted(df[col].cat.categories))
+        record['rows'] = len(df)
+
+    return df
+
+
+def _survival_source(overwrite = False):
+    source_path = os.path.join(paths()['data'], "survival_merged.parquet")
+    if overwrite or not os.path.exists(source_path):
+        merged_survival(overwrite = overwrite)
+    return source_path
+
+def _survival_features(lf, required_cols, naics4 = False, moments = None):
+    lf = _drop_missing(lf, list(required_cols))
+    lf = _standardize(lf, moments).with_columns([
+        pl.col('employees').log1p().alias('log_employees'),
+        pl.col('sales').log1p().alias('log_sales'),
+    ])
+    return _codes(lf, naics4 = naics4)
+
+def survival_lazy(required_cols = SURVIVAL_REQUIRED, naics4 = False, overwrite = False):
+    # uncollected survival features for streaming estimators
+    lf = pl.scan_parquet(_survival_source(overwrite = overwrite))
+    moments = _moments(_drop_missing(lf, list(required_cols)))
+    return _survival_features(lf, required_cols, naics4 = naics4, moments = moments)
+
+def survival_frame(required_cols = SURVIVAL_REQUIRED, dummies = (), naics4 = False, overwrite = False):
+    source_path = _survival_source(overwrite = overwrite)
+
+    spec = {
+        'required': list(required_cols),
+        'dummies': list(dummies),
+        'naics4': naics4,
+        'source': _source_fingerprint(source_path),
+    }
+
+    def build():
+        lf = pl.scan_parquet(source_path)
+        initial_len = lf.select(pl.len()).collect().item()
+
+        df = _survival_features(lf, required_cols, naics4 = naics4).collect()
+        print(f"Dropped {initial_len - df.height} rows due to missing required columns.")
+
+        return _dummies(df, dummies)
+
+    return _load_or_build('survival', spec, build, overwrite)
+
+
+def _growth_required(baseline_year, required_cols):
+    if required_cols is None:
+        return [f'sales_{baseline_year}', 'ec', 'fips', f'emp_{baseline_year}', 'naics']
+    return list(required_cols)
+
+def _growth_sample(b, o, required_cols, survivors_only):
+    lf = growth_panel(baseline_year = b, outcome_year = o)
+
+    # filter for survivors only (intensive margin)
+    if survivors_only:
+        lf = lf.filter(pl.col(f'sales_{o}') > 0)
+
+    return _drop_missing(lf, required_cols).filter(pl.col(f'sales_{b}') > 0)
+
+def _growth_features(lf, b, o, naics4 = False, moments = None):
+    lf = _standardize(lf, moments).with_columns([
+        pl.col(f'sales_{b}').log1p().alias(f'log_sales_{b}'),
+        pl.col(f'sales_{o}').log1p().alias(f'log_sales_{o}'),
+        pl.col(f'emp_{b}').log1p().alias(f'log_emp_{b}'),
+    ]).with_columns(
+        (pl.col(f'log_sales_{o}') - pl.col(f'log_sales_{b}')).alias('log_sales_change')
+    )
+    return _codes(lf, naics4 = naics4)
+
+def growth_lazy(baseline_year = 2019, outcome_year = 2024, required_cols = None,
+                survivors_only = True, naics4 = False, overwrite = False):
+    # uncollected growth features for streaming estimators
+    b, o = baseline_year, outcome_year
+    ensure_panel_dataset(overwrite = overwrite)
+    lf = _growth_sample(b, o, _growth_required(b, required_cols), survivors_only)
+    return _growth_features(lf, b, o, naics4 = naics4, moments = _moments(lf))
+
+def growth_frame(baseline_year = 2019, outcome_year = 2024, required_cols = None,
+                 survivors_only = True, naics4 = False, overwrite = False):
+    b, o = baseline_year, outcome_year
+    required_cols = _growth_required(b, required_cols)
+
+    # make sure the partitioned store exists (and is rebuilt on overwrite)
+    ensure_panel_dataset(overwrite = overwrite)
+    source_path = os.path.join(paths()['data'], "combined_merged.parquet")
+
+    spec = {
+        'baseline_year': b,
+        'outcome_year': o,
+        'required': list(required_cols),
+        'survivors_only': survivors_only,
+        'naics4': naics4,
+        'source': _source_fingerprint(source_path),
+    }
+
+    def build():
+        lf = _growth_sample(b, o, required_cols, survivors_only)
+        return _growth_features(lf, b, o, naics4 = naics4).collect()
+
+    return _load_or_build('growth', spec, build, overwrite)
+
+
+def growth_windows(windows, overwrite = False):
+    # every (baseline, outcome) window stacked from one lazy scan of the panel, all
+    # baseline firms; standardisation and logs are per window, as growth_frame does for one
+    windows = sorted(set((int(b), int(o)) for b, o in windows))
+    if not windows:
+        raise ValueError("growth_windows needs at least one (baseline_year, outcome_year) window")
+    required_cols = ['sales', 'ec', 'fips', 'employees', 'naics', 'clustering', 'civic']
+
+    ensure_panel_dataset(overwrite = overwrite)
+    source_path = os.path.join(paths()['data'], "combined_merged.parquet")
+    spec = {'windows': windows, 'source': _source_fingerprint(source_path)}
+
+    def build():
+        lf = _drop_missing(growth_panels(windows), required_cols).filter(pl.col('sales') > 0)
+        window = ['baseline_year', 'outcome_year']
+        lf = lf.with_columns([
+            ((pl.col(c) - pl.col(c).mean().over(window)) / pl.col(c).std().over(window)).alias(f"{c}_std")
+            for c in SOCIAL_CAPITAL
+        ] + [
+            pl.col('employees').log1p().alias('log_employees'),
+        ])
+        return _codes(lf).collect()
+
+    return _load_or_build('windows', spec, build, overwrite)
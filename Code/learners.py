@@ -0,0 +1,97 @@
+# XGBoost learners for the DML nuisances
+# Daman Dhaliwal
+
+# import libraries
+import numpy as np
+import pandas as pd
+import os
+import xgboost as xgb
+from xgboost import XGBRegressor, XGBClassifier
+
+from utils import paths
+
+# histogram trees with native categorical splits; same depth/rounds as the original learners
+XGB_PARAMS = {
+    'n_estimators': 200,
+    'max_depth': 3,
+    'learning_rate': 0.1,
+    'random_state': 42,
+    'tree_method': 'hist',
+    'max_bin': 256,
+    'enable_categorical': True,
+}
+
+def make_classifier(n_jobs = -1, **overrides):
+    params = {**XGB_PARAMS, 'n_jobs': n_jobs, 'eval_metric': 'logloss', **overrides}
+    return XGBClassifier(**params)
+
+def make_regressor(n_jobs = -1, **overrides):
+    params = {**XGB_PARAMS, 'n_jobs': n_jobs, **overrides}
+    return XGBRegressor(**params)
+
+def categorical_controls(data, numeric, categorical = ('state',)):
+    # controls with state/naics as pandas categories instead of ~50 one-hot columns
+    X = data[list(numeric)].copy()
+    for col in categorical:
+        if col not in data.columns and col == 'state':
+            values = data['fips'].astype(str).str[:2]
+        else:
+            values = data[col].astype(str)
+        X[col] = values.astype('category')
+    return X
+
+
+def take_rows(X, idx):
+    # rows of a frame, or of a (memory-mapped) array
+    return X.iloc[idx] if isinstance(X, pd.DataFrame) else X[idx]
+
+
+class BatchIter(xgb.DataIter):
+    # feeds xgboost row batches of a frame or array so it never needs one dense copy of the design
+    def __init__(self, X, y, rows, batch_size, cache_prefix = None):
+        self._X = X
+        self._y = y
+        self._rows = rows
+        self._batch_size = batch_size
+        self._it = 0
+        super().__init__(cache_prefix = cache_prefix)
+
+    def next(self, input_data):
+        start = self._it * self._batch_size
+        if start >= len(self._rows):
+            return False
+        idx = self._rows[start:start + self._batch_size]
+        input_data(data = take_rows(self._X, idx), label = self._y[idx])
+        self._it += 1
+        return True
+
+    def reset(self):
+        self._it = 0
+
+
+def _booster_params(learner):
+    params = learner.get_xgb_params()
+    for key in ['enable_categorical', 'n_estimators', 'use_label_encoder']:
+        params.pop(key, None)
+    return {k: v for k, v in params.items() if v is not None}
+
+def fit_external(learner, X, y, rows, batch_size = 1_000_000, external_memory = False):
+    # train on a quantized matrix built batch by batch (on disk when external_memory)
+    if external_memory:
+        cache_dir = os.path.join(paths()['models'], 'xgb_cache')
+        os.makedirs(cache_dir, exist_ok = True)
+        it = BatchIter(X, y, rows, batch_size, cache_prefix = os.path.join(cache_dir, 'cache'))
+        dtrain = xgb.ExtMemQuantileDMatrix(it, max_bin = learner.max_bin, enable_categorical = True)
+    else:
+        it = BatchIter(X, y, rows, batch_size)
+        dtrain = xgb.QuantileDMatrix(it, max_bin = learner.max_bin, enable_categorical = True)
+
+    return xgb.train(_booster_params(learner), dtrain, num_boost_round = learner.n_estimators)
+
+def predict_batches(booster, X, rows, batch_size = 1_000_000):
+    # binary:logistic boosters return probabilities, matching predict_proba[:, 1]
+    preds = np.empty(len(rows))
+    for start in range(0, len(rows), batch_size):
+        idx = rows[start:start + batch_size]
+        preds[start:start + len(idx)] = booster.inplace_predict(take_rows(X, idx))
+    return preds
@@ -0,0 +1,86 @@
+# Cached cross-fitted nuisance predictions for DML
+# Daman Dhaliwal
+
+# import libraries
+import numpy as np
+import pandas as pd
+import os
+import json
+import hashlib
+from sklearn.base import clone, is_classifier
+from sklearn.model_selection import KFold
+
+from checkpoint import frame_hash, array_hash
+from learners import fit_external, predict_batches, take_rows
+from utils import paths
+from profiling import stage
+
+
+def sample_splits(n_obs, n_folds = 5, seed = 42):
+    # one fold assignment shared by every treatment (DoubleML all_smpls layout for n_rep = 1)
+    kf = KFold(n_splits = n_folds, shuffle = True, random_state = seed)
+    return [(train, test) for train, test in kf.split(np.arange(n_obs))]
+
+def _splits_hash(splits):
+    digest = hashlib.sha1()
+    for _, test in splits:
+        digest.update(np.asarray(test, dtype = np.int64).tobytes())
+    return digest.hexdigest()[:12]
+
+def nuisance_key(y, X, splits, learner, batch_size = None, external_memory = False):
+    # X is a frame or a design array (see design.py), hashed by its file when memory-mapped
+    if isinstance(X, pd.DataFrame):
+        x_cols, data = list(X.columns), frame_hash(X.assign(**{f'__y_{y.name}': y.values}))
+    else:
+        x_cols, data = X.shape[1], array_hash(X) + array_hash(np.asarray(y.values))
+    spec = {
+        'outcome': y.name,
+        'x_cols': x_cols,
+        'splits': _splits_hash(splits),
+        'learner': type(learner).__name__,
+        'params': learner.get_params(),
+        'data': data,
+        'batch_size': batch_size,
+        'external_memory': external_memory,
+    }
+    payload = json.dumps(spec, sort_keys = True, default = str)
+    return hashlib.sha1(payload.encode()).hexdigest()[:16]
+
+def cross_fit(learner, X, y, splits, overwrite = False, batch_size = None, external_memory = False):
+    # out-of-fold predictions g(X) / m(X), cached on disk by (outcome, X, folds, learner, data)
+    cache_dir = os.path.join(paths()['models'], 'nuisance')
+    os.makedirs(cache_dir, exist_ok = True)
+    key = nuisance_key(y, X, splits, learner, batch_size, external_memory)
+    cache_path = os.path.join(cache_dir, f"{y.name}_{key}.npy")
+
+    if not overwrite and os.path.exists(cache_path):
+        return np.load(cache_path)
+
+    with stage('nuisance.cross_fit', outcome = y.name, learner = type(learner).__name__,
+               batch_size = batch_size) as record:
+        record['rows'] = len(y)
+        preds = _cross_fit(learner, X, y, splits, batch_size, external_memory)
+
+    np.save(cache_path, preds)
+    return preds
+
+def _cross_fit(learner, X, y, splits, batch_size, external_memory):
+    preds = np.full(len(y), np.nan)
+    y_values = y.values
+
+    # xgboost learners can train from row batches instead of a dense in-memory frame
+    if batch_size is not None:
+        for train, test in splits:
+            booster = fit_external(learner, X, y_values, train, batch_size, external_memory)
+            preds[test] = predict_batches(booster, X, test, batch_size)
+        return preds
+
+    for train, test in splits:
+        model = clone(learner)
+        model.fit(take_rows(X, train), y_values[train])
+        if is_classifier(model):
+            preds[test] = model.predict_proba(take_rows(X, test))[:, 1]
+        else:
+            preds[test] = model.predict(take_rows(X, test))
+
+    return preds
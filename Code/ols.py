@@ -5,78 +5,104 @@
 import pandas as pd
 import statsmodels.formula.api as smf
 import numpy as np
-
-from data_prep import merged_survival, merged_combined
-
-def run_ols_survival(formula, overwrite = False):
-    data = merged_survival(overwrite = overwrite)
-
-    data = data.to_pandas()
-
-    required_cols = ['survived_2024', 'ec', 'employees', 'sales', 'fips', 'naics', 'naics2']
-    initial_len = len(data)
-    data = data.dropna(subset=required_cols)
-    print(f"Dropped {initial_len - len(data)} rows due to missing required columns.")
-
-    data = data.drop('firm_age', axis = 1)
-
-    # standardize all continuous variables - employees, sales, ec, clustering, civic
-    data['ec_std'] = (data['ec'] - data['ec'].mean()) / data['ec'].std()
-    data['clustering_std'] = (data['clustering'] - data['clustering'].mean()) / data['clustering'].std()
-    data['civic_std'] = (data['civic'] - data['civic'].mean()) / data['civic'].std()
-    data['log_employees'] = np.log1p(data['employees'])
-    data['log_sales'] = np.log1p(data['sales'])
-    data['state'] = data['fips'].str[:2]
+import os
+
+from features import survival_frame, growth_frame, survival_lazy, growth_lazy
+from fe_ols import parse_formula, fit_fe_ols, fit_fe_batch, fit_fe_design, print_summary, regression_table
+from design import survival_design, growth_design
+from streaming_ols import stream_ols
+from utils import paths
+from profiling import timed
+
+def _nobs(result):
+    # estimation sample of a fit (fe/stream result dict or statsmodels results) or of a batch
+    if isinstance(result, tuple):
+        result = result[0][0]
+    return result['nobs'] if isinstance(result, dict) else int(result.nobs)
+
+def _fit(formula, data, engine):
+    # statsmodels results by default; 'fe' absorbs the C(...) terms instead of building a
+    # dense dummy design and returns a dict of params/bse/pvalues/nobs
+    if engine == 'fe':
+        result = fit_fe_ols(formula, data, cluster = 'fips')
+        print_summary(result)
+        return result
 
     model = smf.ols(formula = formula, data = data).fit(cov_type = 'cluster', cov_kwds = {'groups': data['fips']})
     print(model.summary())
 
     return model
 
-def run_ols_main(formula, overwrite = False):
-    df = merged_combined(overwrite = overwrite)
-    df = df.to_pandas()
-
-    # prep baseline 2019
-    cols = ['abi', 'fips', 'sales', 'employees', 'naics', 'ec', 'clustering', 'civic']
-    cols = [c for c in cols if c in df.columns]
-    
-    data_2019 = df[df['file_year'] == 2019][cols].copy()
-    data_2019 = data_2019.rename(columns={'sales': 'sales_2019', 'employees': 'emp_2019'})
-
-    # prep outcome 2024
-    data_2024 = df[df['file_year'] == 2024][['abi', 'sales']].copy()
-    data_2024 = data_2024.rename(columns={'sales': 'sales_2024'})
-
-    # merge and fill
-    merged = data_2019.merge(data_2024, on='abi', how='left')
-    merged['sales_2024'] = merged['sales_2024'].fillna(0)
-
-    # filter for survivors only (intensive margin)
-    merged = merged[merged['sales_2024'] > 0]
-
-    # drop missing
-    merged = merged.dropna(subset = ['sales_2019', 'ec', 'fips', 'emp_2019', 'naics'])
-    merged = merged[merged['sales_2019'] > 0]
-
-    # transformations
-    merged['log_sales_2019'] = np.log1p(merged['sales_2019'])
-    merged['log_sales_2024'] = np.log1p(merged['sales_2024'])
-    merged['log_sales_change'] = merged['log_sales_2024'] - merged['log_sales_2019']
-
-    # standardize and log controls
-    merged['ec_std'] = (merged['ec'] - merged['ec'].mean()) / merged['ec'].std()
-    merged['clustering_std'] = (merged['clustering'] - merged['clustering'].mean()) / merged['clustering'].std()
-    merged['civic_std'] = (merged['civic'] - merged['civic'].mean()) / merged['civic'].std()
-    
-    merged['log_emp_2019'] = np.log1p(merged['emp_2019'])
-    merged['state'] = merged['fips'].astype(str).str[:2]
-    merged['naics2'] = merged['naics'].astype(str).str[:2]
-
-    model = smf.ols(formula = formula, data = merged).fit(cov_type = 'cluster', cov_kwds = {'groups': merged['fips']})
-    print(model.summary())
-
-    return model
+SURVIVAL_COLS = ['survived_2024', 'ec', 'employees', 'sales', 'fips', 'naics', 'naics2']
+GROWTH_COLS = ['sales_2019', 'ec', 'fips', 'emp_2019', 'naics']
+
+def _survival_data(naics4 = False, overwrite = False):
+    return survival_frame(required_cols = SURVIVAL_COLS, naics4 = naics4, overwrite = overwrite)
+
+def _growth_data(naics4 = False, overwrite = False):
+    # 2019 baseline / 2024 outcome, survivors only (cached)
+    return growth_frame(required_cols = GROWTH_COLS, naics4 = naics4, overwrite = overwrite)
+
+def _design(formulas, sample, naics4 = False, overwrite = False):
+    # memory-mapped regressors, outcome and fixed-effect codes for a batch of formulas;
+    # missing values are kept as NaN so each variant drops only its own incomplete rows
+    parsed = [parse_formula(f) for f in formulas]
+    regressors = list(dict.fromkeys(r for _, regs, _ in parsed for r in regs))
+    build = survival_design if sample == 'survival' else growth_design
+    return build(regressors, y_cols = [parsed[0][0]], codes = list(dict.fromkeys(parsed[0][2] + ['fips'])),
+                 required_cols = SURVIVAL_COLS if sample == 'survival' else GROWTH_COLS,
+                 naics4 = naics4, overwrite = overwrite, drop_missing = False)
+
+@timed(rows = _nobs)
+def run_ols_survival(formula, overwrite = False, engine = 'statsmodels'):
+    # 'stream' never materialises the frame: sufficient statistics over parquet row batches
+    if engine == 'stream':
+        lf = survival_lazy(required_cols = SURVIVAL_COLS, naics4 = 'naics4' in formula, overwrite = overwrite)
+        result = stream_ols(lf, formula, cluster = 'fips')
+        print_summary(result)
+        return result
+
+    data = _survival_data(naics4 = 'naics4' in formula, overwrite = overwrite)
+
+    return _fit(formula, data, engine)
+
+@timed(rows = _nobs)
+def run_ols_main(formula, overwrite = False, engine = 'statsmodels'):
+    if engine == 'stream':
+        lf = growth_lazy(required_cols = GROWTH_COLS, naics4 = 'naics4' in formula, overwrite = overwrite)
+        result = stream_ols(lf, formula, cluster = 'fips')
+        print_summary(result)
+        return result
+
+    merged = _growth_data(naics4 = 'naics4' in formula, overwrite = overwrite)
+
+    return _fit(formula, merged, engine)
+
+@timed(rows = _nobs)
+def run_ols_batch(formulas, sample = 'survival', names = None, filename = None, overwrite = False, mmap = False):
+    # all variants of one specification from a single load, demeaned once per estimation sample;
+    # with mmap the columns are read from an on-disk design instead of a pandas frame
+    naics4 = any('naics4' in f for f in formulas)
+    if mmap:
+        results = fit_fe_design(formulas, _design(formulas, sample, naics4 = naics4, overwrite = overwrite),
+                                cluster = 'fips')
+    else:
+        if sample == 'survival':
+            data = _survival_data(naics4 = naics4, overwrite = overwrite)
+        else:
+            data = _growth_data(naics4 = naics4, overwrite = overwrite)
+        results = fit_fe_batch(formulas, data, cluster = 'fips')
+
+    for result in results:
+        print_summary(result)
+
+    table = regression_table(results, names = names)
+    filename = filename or f"ols_{sample}.csv"
+    os.makedirs(paths()['tables'], exist_ok = True)
+    table.to_csv(os.path.join(paths()['tables'], filename))
+    print(f"\nSaved {filename} to {paths()['tables']}")
+
+    return results, table
 
 # Survival formulas
 SURV_EC = "survived_2024 ~ ec_std + log_employees + C(state) + C(naics2)"
@@ -90,12 +116,12 @@ GROWTH_COH = "log_sales_change ~ clustering_std + log_sales_2019 + C(state) + C(
 GROWTH_CIV = "log_sales_change ~ civic_std + log_sales_2019 + C(state) + C(naics2)"
 GROWTH_JOINT = "log_sales_change ~ ec_std + clustering_std + civic_std + log_sales_2019 + C(state) + C(naics2)"
 
+# High-dimensional fixed effects (fe engine only)
+SURV_JOINT_NAICS4 = "survived_2024 ~ ec_std + clustering_std + civic_std + log_employees + C(state) + C(naics4)"
+GROWTH_JOINT_NAICS4 = "log_sales_change ~ ec_std + clustering_std + civic_std + log_sales_2019 + C(state) + C(naics4)"
+
 if __name__ == "__main__":
-    run_ols_survival(SURV_JOINT)
-    run_ols_survival(SURV_EC)
-    run_ols_survival(SURV_COH)
-    run_ols_survival(SURV_CIV)
-    run_ols_main(GROWTH_JOINT)
-    run_ols_main(GROWTH_EC)
-    run_ols_main(GROWTH_COH)
-    run_ols_main(GROWTH_CIV)
\ No newline at end of file
+    run_ols_batch([SURV_JOINT, SURV_EC, SURV_COH, SURV_CIV], sample = 'survival',
+                  names = ['Joint', 'EC', 'Cohesion', 'Civic'])
+    run_ols_batch([GROWTH_JOINT, GROWTH_EC, GROWTH_COH, GROWTH_CIV], sample = 'growth',
+                  names = ['Joint', 'EC', 'Cohesion', 'Civic'])
\ No newline at end of file
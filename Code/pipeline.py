@@ -0,0 +1,307 @@
+# Dependency-aware pipeline runner with a content-hashed artifact cache
+# Daman Dhaliwal
+
+# import libraries
+import os
+import json
+import hashlib
+import importlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from utils import paths, available_cores
+from profiling import stage
+
+STATE_NAME = "pipeline_state.json"
+# thread pools sized from the environment when a node process starts
+THREAD_VARS = ['SC_CORES', 'OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'POLARS_MAX_THREADS']
+CODE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+# stage functions that bundle several calls or save output that the module only prints
+def build_features():
+    from features import survival_frame, growth_frame
+    survival_frame(required_cols = ['survived_2024', 'ec', 'employees', 'sales', 'fips', 'naics', 'naics2'])
+    growth_frame(required_cols = ['sales_2019', 'ec', 'fips', 'emp_2019', 'naics'])
+
+def summary_table():
+    from data_description import summary_stats
+    os.makedirs(paths()['tables'], exist_ok = True)
+    summary_stats().to_csv(os.path.join(paths()['tables'], 'summary_stats.csv'))
+
+def ols_tables():
+    import ols
+    names = ['Joint', 'EC', 'Cohesion', 'Civic']
+    ols.run_ols_batch([ols.SURV_JOINT, ols.SURV_EC, ols.SURV_COH, ols.SURV_CIV], sample = 'survival', names = names)
+    ols.run_ols_batch([ols.GROWTH_JOINT, ols.GROWTH_EC, ols.GROWTH_COH, ols.GROWTH_CIV], sample = 'growth', names = names)
+
+def quantreg_results():
+    from quantreg import run_quantreg, plot_quantile_results
+    results, _ = run_quantreg()
+    plot_quantile_results(results)
+
+
+# node: dependencies, (module, function, kwargs) to run, source files whose edits make it
+# stale, raw inputs, and artifacts as (paths() key, name); a directory is hashed file by file
+NODES = {
+    'ingest': {
+        'deps': [],
+        # only years whose raw file changed are re-parsed; streaming/parallel/workers etc.
+        # can be set through run_pipeline(options={'ingest': {...}})
+        # the merged files and the partitioned store are left to their own nodes below
+        'run': ('data_prep', 'load_data', {'overwrite': True, 'incremental': True, 'refresh_merged': False}),
+        'code': ['data_prep.py'],
+        'inputs': [('data_input', 'business_data')],
+        'outputs': [('data', 'business_panel_full.parquet'), ('data', 'business_survival_2019.parquet')],
+    },
+    'merged_survival': {
+        'deps': ['ingest'],
+        'run': ('data_prep', 'merged_survival', {'overwrite': True}),
+        'code': ['data_prep.py'],
+        'inputs': [('data_input', os.path.join('OI_data', 'social_capital_county.csv'))],
+        'outputs': [('data', 'survival_merged.parquet')],
+    },
+    'merged_combined': {
+        'deps': ['ingest'],
+        'run': ('data_prep', 'merged_combined', {'overwrite': True}),
+        'code': ['data_prep.py'],
+        'inputs': [('data_input', os.path.join('OI_data', 'social_capital_county.csv'))],
+        'outputs': [('data', 'combined_merged.parquet')],
+    },
+    'panel': {
+        'deps': ['merged_combined'],
+        'run': ('data_prep', 'write_panel_dataset', {'overwrite': True}),
+        'code': ['data_prep.py'],
+        'inputs': [],
+        'outputs': [('data', 'panel_dataset')],
+    },
+    'features': {
+        'deps': ['merged_survival', 'panel'],
+        'run': ('pipeline', 'build_features', {}),
+        'code': ['features.py'],
+        'inputs': [],
+        'outputs': [],
+    },
+    'summary': {
+        'deps': ['features'],
+        'run': ('pipeline', 'summary_table', {}),
+        'code': ['data_description.py', 'describe.py'],
+        'inputs': [],
+        'outputs': [('tables', 'summary_stats.csv')],
+    },
+    'ols': {
+        'deps': ['features'],
+        'run': ('pipeline', 'ols_tables', {}),
+        'code': ['ols.py', 'fe_ols.py', 'design.py'],
+        'inputs': [],
+        'outputs': [('tables', 'ols_survival.csv'), ('tables', 'ols_growth.csv')],
+    },
+    'placebo': {
+        'deps': ['panel'],
+        'run': ('data_description', 'run_placebo_sweep', {}),
+        'code': ['data_description.py', 'features.py', 'fe_ols.py'],
+        'inputs': [],
+        'outputs': [('data', 'placebo_sweep.csv'), ('plots', 'placebo_sweep.png')],
+    },
+    'quantreg': {
+        'deps': ['features'],
+        'run': ('pipeline', 'quantreg_results', {}),
+        'code': ['quantreg.py', 'quantile.py', 'shared.py', 'design.py'],
+        'inputs': [],
+        'outputs': [('data', 'quant_reg_results.csv'), ('plots', 'quantile_regression_results.png')],
+    },
+    'dml_joint': {
+        'deps': ['features'],
+        'run': ('dml', 'run_dml_joint', {}),
+        'code': ['dml.py', 'nuisance.py', 'learners.py', 'design.py'],
+        'inputs': [],
+        'outputs': [('data', 'dml_joint_results.csv'), ('data', 'dml_joint_vcov.csv')],
+    },
+    'dml_industry': {
+        'deps': ['features'],
+        'run': ('dml', 'run_industry_dml', {}),
+        'code': ['dml.py', 'learners.py', 'checkpoint.py'],
+        'inputs': [],
+        'outputs': [('data', 'dml_industry_results.csv')],
+    },
+    'refuters': {
+        'deps': ['features'],
+        'run': ('refuters', 'run_refuters', {}),
+        'code': ['refuters.py', 'shared.py'],
+        'inputs': [],
+        'outputs': [('data', 'refutation_results.csv')],
+    },
+}
+
+
+def _state_path():
+    return os.path.join(paths()['parent_dir'], 'Output', STATE_NAME)
+
+def read_state():
+    path = _state_path()
+    if not os.path.exists(path):
+        return {'nodes': {}, 'files': {}}
+    with open(path) as f:
+        return json.load(f)
+
+def write_state(state):
+    path = _state_path()
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(state, f, indent = 2, sort_keys = True)
+    os.replace(tmp, path)
+
+def _file_digest(file, files):
+    # content hash, reused while size and mtime are unchanged so large parquet files
+    # are only read again after they have been rewritten
+    stat = os.stat(file)
+    cached = files.get(file)
+    if cached and cached['size'] == stat.st_size and cached['mtime_ns'] == stat.st_mtime_ns:
+        return cached['sha256']
+
+    digest = hashlib.sha256()
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(8 * 1024**2), b''):
+            digest.update(block)
+    files[file] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': digest.hexdigest()}
+    return files[file]['sha256']
+
+def artifact_hash(path, files):
+    if os.path.isfile(path):
+        return _file_digest(path, files)
+    if not os.path.isdir(path):
+        return None
+    digest = hashlib.sha256()
+    for root, dirs, names in os.walk(path):
+        dirs.sort()
+        for name in sorted(names):
+            file = os.path.join(root, name)
+            digest.update(os.path.relpath(file, path).encode())
+            digest.update(_file_digest(file, files).encode())
+    return digest.hexdigest()
+
+def _artifacts(node, kind):
+    return [os.path.join(paths()[key], name) for key, name in NODES[node][kind]]
+
+def node_run(node, options = None):
+    # (module, function, kwargs) with any per-run overrides of the node's kwargs
+    module, func, kwargs = NODES[node]['run']
+    return module, func, {**kwargs, **((options or {}).get(node) or {})}
+
+def node_key(node, state, options = None):
+    # everything a node's result depends on: its code, raw inputs, kwargs and the
+    # content of its dependencies' artifacts
+    spec = NODES[node]
+    files = state['files']
+    payload = {
+        'run': node_run(node, options),
+        'code': {f: _file_digest(os.path.join(CODE_DIR, f), files) for f in spec['code']},
+        'inputs': {p: artifact_hash(p, files) for p in _artifacts(node, 'inputs')},
+        'deps': {d: state['nodes'].get(d, {}).get('key') if not NODES[d]['outputs'] else
+                 {p: artifact_hash(p, files) for p in _artifacts(d, 'outputs')} for d in spec['deps']},
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys = True, default = str).encode()).hexdigest()
+
+def is_stale(node, state, options = None):
+    record = state['nodes'].get(node)
+    if record is None or record['key'] != node_key(node, state, options):
+        return True
+    # a missing or hand-edited artifact is rebuilt as well
+    outputs = {p: artifact_hash(p, state['files']) for p in _artifacts(node, 'outputs')}
+    return outputs != record['outputs']
+
+def ancestors(targets):
+    needed, stack = set(), list(targets)
+    while stack:
+        node = stack.pop()
+        if node not in needed:
+            needed.add(node)
+            stack += NODES[node]['deps']
+    return needed
+
+def run_node(node, options = None):
+    module, func, kwargs = node_run(node, options)
+    with stage(f"pipeline.{node}"):
+        getattr(importlib.import_module(module), func)(**kwargs)
+    return node
+
+def run_pipeline(targets = None, workers = None, force = (), dry_run = False, options = None):
+    # nodes run as soon as their dependencies are done; fresh nodes are skipped and
+    # independent estimators share the pool. options maps a node to kwargs overriding
+    # its defaults, e.g. {'ingest': {'parallel': True, 'workers': 8}}
+    needed = ancestors(targets or list(NODES))
+    state = read_state()
+    force = set(force)
+
+    workers = workers or min(4, available_cores())
+
+    # each concurrent node gets an even share of the cores: its own pools (available_cores)
+    # and the openmp/BLAS/polars thread pools of the spawned node processes stay within it
+    budget = max(1, available_cores() // workers)
+    previous = {var: os.environ.get(var) for var in THREAD_VARS}
+    os.environ.update({var: str(budget) for var in THREAD_VARS})
+    print(f"Running up to {workers} nodes at once, {budget} cores each")
+
+    ctx = multiprocessing.get_context('spawn')
+    try:
+        done, failed = _schedule(needed, state, workers, ctx, force, dry_run, options)
+    finally:
+        for var, value in previous.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+
+    if failed:
+        raise RuntimeError(f"Pipeline nodes failed: {sorted(failed)}")
+    return done
+
+def _schedule(needed, state, workers, ctx, force, dry_run, options):
+    done, failed, running = set(), set(), {}
+    with ProcessPoolExecutor(max_workers = workers, mp_context = ctx) as pool:
+        while True:
+            progressed = True
+            while progressed:
+                progressed = False
+                for node in sorted(needed - done - failed - set(running)):
+                    deps = NODES[node]['deps']
+                    if any(d in failed for d in deps):
+                        print(f"[skip]  {node} (upstream failed)")
+                        failed.add(node)
+                        progressed = True
+                    elif all(d in done for d in deps):
+                        if node not in force and not is_stale(node, state, options):
+                            print(f"[fresh] {node}")
+                            done.add(node)
+                            progressed = True
+                        elif dry_run:
+                            print(f"[stale] {node}")
+                            done.add(node)
+                            progressed = True
+                        else:
+                            print(f"[run]   {node}")
+                            running[node] = pool.submit(run_node, node, options)
+
+            if not running:
+                break
+
+            finished, _ = wait(running.values(), return_when = FIRST_COMPLETED)
+            for node in [n for n, f in running.items() if f in finished]:
+                future = running.pop(node)
+                if future.exception() is not None:
+                    print(f"[fail]  {node}: {future.exception()!r}")
+                    failed.add(node)
+                    continue
+                state['nodes'][node] = {
+                    'key': node_key(node, state, options),
+                    'outputs': {p: artifact_hash(p, state['files']) for p in _artifacts(node, 'outputs')},
+                }
+                write_state(state)
+                done.add(node)
+                print(f"[done]  {node}")
+
+    return done, failed
+
+if __name__ == "__main__":
+    run_pipeline()
@@ -0,0 +1,222 @@
+# Stage timing, CPU, memory and row-count instrumentation
+# Daman Dhaliwal
+
+# import libraries
+import pandas as pd
+import os
+import sys
+import json
+import time
+import signal
+import shutil
+import resource
+import cProfile
+import functools
+import subprocess
+from contextlib import contextmanager
+
+from utils import paths
+
+LOG_NAME = "run_log.jsonl"
+
+# one id per top-level run; spawned workers inherit it through the environment
+RUN_ID = os.environ.setdefault('SC_RUN_ID', f"{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}")
+
+# open stages in this process, innermost last
+_STACK = []
+
+
+def log_path():
+    return os.path.join(paths()['parent_dir'], 'Output', LOG_NAME)
+
+def _status_kb(field):
+    # VmRSS / VmHWM from /proc (Linux); None elsewhere
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def _reset_peak():
+    # writing 5 to clear_refs resets VmHWM, so each stage reports its own peak
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def _peak_kb():
+    peak = _status_kb('VmHWM')
+    if peak is None:
+        # lifetime peak; ru_maxrss is in bytes on macOS, kilobytes on Linux
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak //= 1024 if sys.platform == 'darwin' else 1
+    return peak
+
+def count_rows(obj):
+    # rows of a pandas/polars frame or array, or of the first item of a returned tuple
+    if isinstance(obj, tuple) and obj:
+        obj = obj[0]
+    if hasattr(obj, 'height'):
+        return obj.height
+    if hasattr(obj, 'shape') and len(obj.shape):
+        return int(obj.shape[0])
+    return None
+
+def _profiled(name, profile):
+    # profile=True/'cprofile'/'py-spy'; otherwise SC_PROFILE names the stages ('*' for all)
+    # and SC_PROFILER picks the tool
+    if profile is None:
+        wanted = os.environ.get('SC_PROFILE', '')
+        if wanted == '*' or name in wanted.split(','):
+            profile = os.environ.get('SC_PROFILER', 'cprofile')
+    if profile is True:
+        profile = 'cprofile'
+    return profile or None
+
+def _start_profiler(name, profile):
+    profile_dir = os.path.join(paths()['parent_dir'], 'Output', 'profiles')
+    os.makedirs(profile_dir, exist_ok = True)
+    stem = os.path.join(profile_dir, f"{name.replace('/', '_')}_{RUN_ID}_{os.getpid()}")
+
+    if profile == 'py-spy':
+        if shutil.which('py-spy') is None:
+            print("py-spy not found on PATH; stage is not profiled")
+            return None
+        # sampling profiler attached from outside; flame graph written when it is interrupted
+        proc = subprocess.Popen(['py-spy', 'record', '--pid', str(os.getpid()), '--subprocesses',
+                                 '--output', stem + '.svg'], stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+        return 'py-spy', proc, stem + '.svg'
+
+    prof = cProfile.Profile()
+    prof.enable()
+    return 'cprofile', prof, stem + '.prof'
+
+def _stop_profiler(profiler):
+    kind, handle, file = profiler
+    if kind == 'py-spy':
+        handle.send_signal(signal.SIGINT)
+        handle.wait()
+    else:
+        handle.disable()
+        handle.dump_stats(file)
+    return file
+
+def _write(record):
+    path = log_path()
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    # one short append per record, so concurrent workers do not interleave lines
+    with open(path, 'a') as f:
+        f.write(json.dumps(record, default = str) + '\n')
+
+
+@contextmanager
+def stage(name, profile = None, **fields):
+    # times the block and appends one JSON line to Output/run_log.jsonl; the yielded dict
+    # takes extra fields, e.g. record['rows'] = len(df)
+    record = {'run': RUN_ID, 'stage': name, 'pid': os.getpid(),
+              'parent': _STACK[-1]['stage'] if _STACK else None, 'rows': None, **fields}
+
+    # the enclosing stage keeps the peak reached so far before this one resets it
+    if _STACK:
+        _STACK[-1]['_peak'] = max(_STACK[-1]['_peak'], _peak_kb())
+    record['_peak'] = 0
+    record['_profiled'] = False
+    exact_peak = _reset_peak()
+    _STACK.append(record)
+
+    # one profiler per process: a stage nested in a profiled one is already covered by
+    # the outer profile, and a second cProfile would take over (then remove) its hook
+    profiler = _profiled(name, profile)
+    outer = next((r['stage'] for r in reversed(_STACK[:-1]) if r['_profiled']), None)
+    if profiler and outer:
+        record['profile'] = f"in {outer}"
+        profiler = None
+    profiler = _start_profiler(name, profiler) if profiler else None
+    record['_profiled'] = profiler is not None
+
+    rss = _status_kb('VmRSS')
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    started = time.time()
+    wall, cpu = time.perf_counter(), time.process_time()
+    status, error = 'ok', None
+    try:
+        yield record
+    except BaseException as e:
+        status, error = 'error', repr(e)
+        raise
+    finally:
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        if profiler:
+            record['profile'] = _stop_profiler(profiler)
+
+        _STACK.pop()
+        record.pop('_profiled')
+        peak = max(record.pop('_peak'), _peak_kb())
+        if _STACK:
+            _STACK[-1]['_peak'] = max(_STACK[-1]['_peak'], peak)
+
+        record.update({
+            'start': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(started)),
+            'wall_s': round(wall, 4),
+            'cpu_s': round(cpu, 4),
+            # worker processes that exited during the stage (process pools)
+            'children_cpu_s': round((children_after.ru_utime + children_after.ru_stime)
+                                    - (children.ru_utime + children.ru_stime), 4),
+            'rss_start_mb': round(rss / 1024, 1) if rss is not None else None,
+            # with exact_peak False this is the process's lifetime peak, not the stage's
+            'peak_rss_mb': round(peak / 1024, 1),
+            'peak_exact': exact_peak,
+            'status': status,
+            'error': error,
+        })
+        _write(record)
+
+def timed(name = None, rows = count_rows, profile = None):
+    # decorator form of stage; rows(result) fills the row count from the return value
+    def decorator(func):
+        label = name or f"{func.__module__}.{func.__name__}"
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(label, profile = profile) as record:
+                result = func(*args, **kwargs)
+                record['rows'] = rows(result) if rows else None
+            return result
+        return wrapper
+    return decorator
+
+
+def read_log(run = None, path = None):
+    path = path or log_path()
+    if not os.path.exists(path):
+        return pd.DataFrame()
+    with open(path) as f:
+        log = pd.DataFrame([json.loads(line) for line in f if line.strip()])
+    if run == 'last':
+        run = log['run'].iloc[-1]
+    return log[log['run'] == run] if run is not None else log
+
+def stage_report(run = 'last', path = None):
+    # where the time went: calls, total wall/CPU and worst peak memory per stage
+    log = read_log(run = run, path = path)
+    if log.empty:
+        return log
+    report = log.groupby('stage').agg(
+        calls = ('stage', 'size'),
+        wall_s = ('wall_s', 'sum'),
+        cpu_s = ('cpu_s', 'sum'),
+        children_cpu_s = ('children_cpu_s', 'sum'),
+        peak_rss_mb = ('peak_rss_mb', 'max'),
+        rows = ('rows', 'max'),
+        errors = ('status', lambda s: int((s == 'error').sum())),
+    )
+    return report.sort_values('wall_s', ascending = False)
+
+if __name__ == "__main__":
+    print(stage_report().to_string())
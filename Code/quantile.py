@@ -0,0 +1,250 @@
+# Quantile regression engine for the tau grid
+# Daman Dhaliwal
+
+# import libraries
+import pandas as pd
+import numpy as np
+from concurrent.futures import as_completed
+from scipy import stats
+
+from shared import SHARED, share_arrays, release_arrays, shared_pool, local_arrays
+from utils import available_cores
+
+# the preprocessing step only pays off on large samples
+PREPROCESS_MIN_OBS = 200_000
+
+
+def design_matrix(df, x_cols, y_col):
+    # built once per grid instead of once per quantile; constant last, as in .assign(const=1)
+    X = np.empty((len(df), len(x_cols) + 1))
+    X[:, :-1] = df[x_cols].to_numpy(dtype = float)
+    X[:, -1] = 1.0
+    y = df[y_col].to_numpy(dtype = float)
+    return X, y, list(x_cols) + ['const']
+
+def _check_weights(resid, q):
+    # same guard and asymmetric weights as statsmodels QuantReg
+    resid = resid.copy()
+    mask = np.abs(resid) < 0.000001
+    resid[mask] = ((resid[mask] >= 0) * 2 - 1) * 0.000001
+    resid = np.where(resid < 0, q * resid, (1 - q) * resid)
+    return 1.0 / np.abs(resid)
+
+def irls(X, y, q, start = None, max_iter = 1000, p_tol = 1e-6):
+    # iteratively reweighted least squares; the first step is OLS unless warm started
+    if start is None:
+        w = np.ones(len(y))
+        beta = np.ones(X.shape[1])
+    else:
+        beta = np.asarray(start, dtype = float)
+        w = _check_weights(y - X @ beta, q)
+
+    n_iter = 0
+    diff = 10
+    while n_iter < max_iter and diff > p_tol:
+        n_iter += 1
+        beta0 = beta
+        Xw = X * w[:, None]
+        beta = np.linalg.lstsq(Xw.T @ X, Xw.T @ y, rcond = None)[0]
+        w = _check_weights(y - X @ beta, q)
+        diff = np.max(np.abs(beta - beta0))
+
+    return beta, n_iter
+
+def _globbed_fit(X, y, q, start, core, lo, hi):
+    # core rows plus one pseudo-observation per side for everything outside the band
+    parts_X, parts_y = [X[core]], [y[core]]
+    scale = 10 * (np.abs(y).max() + 1) * len(y)
+    for rows, sign in ((lo, -1.0), (hi, 1.0)):
+        if rows.any():
+            x_glob = X[rows].sum(axis = 0)
+            parts_X.append(x_glob[None, :])
+            parts_y.append(np.array([x_glob @ start + sign * scale]))
+    return irls(np.vstack(parts_X), np.concatenate(parts_y), q, start = start)
+
+def preprocess_fit(X, y, q, start = None, seed = 42, max_rounds = 10):
+    # Portnoy-Koenker: fit a subsample, keep only rows near the fitted quantile,
+    # glob the rest, and fix up any globbed row whose residual sign comes out wrong
+    n, k = X.shape
+    rng = np.random.default_rng(seed)
+    m = int(min(n, 2 * (k * n) ** (2 / 3)))
+    total_iter = 0
+
+    for _ in range(max_rounds):
+        sub = rng.choice(n, size = m, replace = False)
+        beta, n_iter = irls(X[sub], y[sub], q, start = start)
+        total_iter += n_iter
+
+        # band of roughly m residuals around the q-th quantile of the full sample
+        resid = y - X @ beta
+        band = m / (2 * n)
+        lo_cut, hi_cut = np.quantile(resid, [max(q - band, 0), min(q + band, 1)])
+        lo, hi = resid < lo_cut, resid > hi_cut
+        core = ~(lo | hi)
+
+        for _ in range(max_rounds):
+            beta, n_iter = _globbed_fit(X, y, q, beta, core, lo, hi)
+            total_iter += n_iter
+
+            # full-data check: globbed rows must stay on their side of the new fit
+            resid = y - X @ beta
+            wrong = (lo & (resid > 0)) | (hi & (resid < 0))
+            n_wrong = int(wrong.sum())
+            if n_wrong == 0:
+                return beta, total_iter
+            if n_wrong > 0.1 * m:
+                break
+            core |= wrong
+            lo &= ~wrong
+            hi &= ~wrong
+
+        # too many sign flips: the band was too narrow, start over with a larger one
+        m = min(n, 2 * m)
+        start = beta
+
+    # fall back to the full problem, warm started from the last fit
+    beta, n_iter = irls(X, y, q, start = beta)
+    return beta, total_iter + n_iter
+
+def _hall_sheather(n, q, alpha = 0.05):
+    z = stats.norm.ppf(q)
+    num = 1.5 * stats.norm.pdf(z) ** 2.0
+    den = 2.0 * z ** 2.0 + 1.0
+    return n ** (-1.0 / 3) * stats.norm.ppf(1.0 - alpha / 2.0) ** (2.0 / 3) * (num / den) ** (1.0 / 3)
+
+def robust_se(X, y, beta, q, xtxi = None):
+    # kernel sandwich covariance: epanechnikov kernel, hall-sheather bandwidth (statsmodels defaults)
+    n = len(y)
+    e = y - X @ beta
+    iqre = np.percentile(e, 75) - np.percentile(e, 25)
+    h = _hall_sheather(n, q)
+    h = min(np.std(y), iqre / 1.34) * (stats.norm.ppf(q + h) - stats.norm.ppf(q - h))
+
+    u = e / h
+    fhat0 = 1.0 / (n * h) * np.sum(0.75 * (1 - u ** 2) * (np.abs(u) <= 1))
+
+    d = np.where(e > 0, (q / fhat0) ** 2, ((1 - q) / fhat0) ** 2)
+    if xtxi is None:
+        xtxi = np.linalg.pinv(X.T @ X)
+    vcov = xtxi @ ((X.T * d) @ X) @ xtxi
+    return np.sqrt(np.diag(vcov))
+
+def fit_grid(X, y, names, quantiles, preprocess = None, seed = 42, max_iter = 1000, p_tol = 1e-6):
+    # fits the grid outward from the median so every tau is warm started from its neighbour;
+    # yields (q, result) as each quantile finishes
+    n, k = X.shape
+    if preprocess is None:
+        preprocess = n >= PREPROCESS_MIN_OBS
+    if len(quantiles) == 0:
+        return
+
+    xtxi = np.linalg.pinv(X.T @ X)
+    df_resid = n - np.linalg.matrix_rank(X)
+
+    quantiles = sorted(quantiles)
+    mid = int(np.argmin(np.abs(np.asarray(quantiles) - 0.5)))
+    upward = quantiles[mid:]
+    downward = quantiles[:mid][::-1]
+
+    start = None
+    anchor = None
+    for i, q in enumerate(upward + downward):
+        # the downward path starts from the median fit rather than the top of the grid
+        if i == len(upward):
+            start = anchor
+
+        if preprocess:
+            beta, n_iter = preprocess_fit(X, y, q, start = start, seed = seed)
+        else:
+            beta, n_iter = irls(X, y, q, start = start, max_iter = max_iter, p_tol = p_tol)
+
+        bse = robust_se(X, y, beta, q, xtxi = xtxi)
+        pvalues = 2 * stats.t.sf(np.abs(beta / bse), df_resid)
+
+        yield q, {
+            'params': pd.Series(beta, index = names),
+            'bse': pd.Series(bse, index = names),
+            'pvalues': pd.Series(pvalues, index = names),
+            'iterations': n_iter,
+        }
+        if i == 0:
+            anchor = beta
+        start = beta
+
+
+def _fit_chunk(names, quantiles, preprocess, seed):
+    return list(fit_grid(SHARED['X'], SHARED['y'], names, quantiles, preprocess = preprocess, seed = seed))
+
+def fit_grid_parallel(X, y, names, quantiles, workers = None, preprocess = None, seed = 42):
+    # contiguous tau chunks per worker, so warm starts still run along each chunk
+    quantiles = sorted(quantiles)
+    workers = min(workers or available_cores(), len(quantiles))
+    if workers <= 1:
+        yield from fit_grid(X, y, names, quantiles, preprocess = preprocess, seed = seed)
+        return
+
+    chunks = [list(c) for c in np.array_split(quantiles, workers)]
+    blocks, specs = share_arrays({'X': X, 'y': y})
+    try:
+        with shared_pool(specs, workers) as pool:
+            futures = [pool.submit(_fit_chunk, names, chunk, preprocess, seed) for chunk in chunks]
+            for future in as_completed(futures):
+                yield from future.result()
+    finally:
+        release_arrays(blocks)
+
+
+def _cluster_index(clusters):
+    # rows grouped by cluster: order[starts[g]:ends[g]] are the rows of cluster g
+    codes = pd.factorize(clusters)[0]
+    order = np.argsort(codes, kind = 'stable')
+    counts = np.bincount(codes)
+    ends = np.cumsum(counts)
+    return order, ends - counts, ends
+
+def _bootstrap_reps(quantiles, starts_beta, seeds, preprocess):
+    X, y = SHARED['X'], SHARED['y']
+    order, starts, ends = SHARED['order'], SHARED['starts'], SHARED['ends']
+    n_clusters = len(starts)
+
+    draws = np.empty((len(seeds), len(quantiles), X.shape[1]))
+    for r, seed in enumerate(seeds):
+        rng = np.random.default_rng(seed)
+        picked = rng.integers(0, n_clusters, size = n_clusters)
+        rows = np.concatenate([order[starts[g]:ends[g]] for g in picked])
+        Xb, yb = X[rows], y[rows]
+
+        # every replicate starts from the full-sample fit at the same tau
+        for j, q in enumerate(quantiles):
+            if preprocess:
+                draws[r, j], _ = preprocess_fit(Xb, yb, q, start = starts_beta[j], seed = seed)
+            else:
+                draws[r, j], _ = irls(Xb, yb, q, start = starts_beta[j])
+    return draws
+
+def cluster_bootstrap(X, y, clusters, quantiles, betas, reps = 200, workers = None,
+                      preprocess = None, seed = 42):
+    # pairs cluster bootstrap: resample whole clusters (counties) with replacement;
+    # returns the bootstrap draws, shape (reps, n_quantiles, k)
+    if preprocess is None:
+        preprocess = len(y) >= PREPROCESS_MIN_OBS
+    order, starts, ends = _cluster_index(clusters)
+    seeds = np.random.SeedSequence(seed).generate_state(reps)
+    starts_beta = np.asarray(betas, dtype = float)
+
+    workers = min(workers or available_cores(), reps)
+    print(f"Cluster bootstrap: {reps} replications over {len(starts)} clusters on {workers} workers")
+    if workers <= 1:
+        with local_arrays({'X': X, 'y': y, 'order': order, 'starts': starts, 'ends': ends}):
+            return _bootstrap_reps(quantiles, starts_beta, seeds, preprocess)
+
+    blocks, specs = share_arrays({'X': X, 'y': y, 'order': order, 'starts': starts, 'ends': ends})
+    try:
+        with shared_pool(specs, workers) as pool:
+            futures = [pool.submit(_bootstrap_reps, quantiles, starts_beta, chunk, preprocess)
+                       for chunk in np.array_split(seeds, workers)]
+            draws = [future.result() for future in futures]
+    finally:
+        release_arrays(blocks)
+
+    return np.concatenate(draws)
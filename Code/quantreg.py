@@ -4,69 +4,91 @@
 # import libraries
 import pandas as pd
 import numpy as np
-from statsmodels.regression.quantile_regression import QuantReg
+from scipy import stats
 from tqdm import tqdm
 import matplotlib.pyplot as plt
+import os
 
-from data_prep import merged_combined
+from features import growth_frame
+from design import growth_design
+from quantile import design_matrix, fit_grid_parallel, cluster_bootstrap, PREPROCESS_MIN_OBS
+from checkpoint import frame_hash, checkpoint_path, load_checkpoint, append_checkpoint
 from utils import paths
-
-def run_quantreg(overwrite = False):
-    df = merged_combined(overwrite = overwrite)
-    df = df.to_pandas()
-
-    data_2019 = df[df['file_year'] == 2019][['abi', 'fips', 'sales', 'employees', 'naics', 'ec', 'clustering', 'civic']].copy()
-    data_2019 = data_2019.rename(columns={'sales': 'sales_2019', 'employees': 'emp_2019'})
-
-    data_2024 = df[df['file_year'] == 2024][['abi', 'sales']].copy()
-    data_2024 = data_2024.rename(columns={'sales': 'sales_2024'})
-
-    merged = data_2019.merge(data_2024, on='abi', how='left')
-    merged['sales_2024'] = merged['sales_2024'].fillna(0)
-
-    # compute sales change
-    merged['survived'] = (merged['sales_2024'] > 0).astype(int)
-
-    merged = merged.dropna(subset = ['sales_2019', 'ec', 'fips', 'emp_2019', 'naics', 'clustering', 'civic'])
-    merged = merged[merged['sales_2019'] > 0]
-
-    # filter for survivors only (intensive margin)
-    merged = merged[merged['sales_2024'] > 0]
-
-    # log sales
-    merged['log_sales_2019'] = np.log1p(merged['sales_2019'])
-    merged['log_sales_2024'] = np.log1p(merged['sales_2024'])
-    merged['log_sales_change'] = merged['log_sales_2024'] - merged['log_sales_2019']
-
-    # standardize independent variables
-    merged['ec_std'] = (merged['ec'] - merged['ec'].mean()) / merged['ec'].std()
-    merged['clustering_std'] = (merged['clustering'] - merged['clustering'].mean()) / merged['clustering'].std()
-    merged['civic_std'] = (merged['civic'] - merged['civic'].mean()) / merged['civic'].std()
-    merged['log_emp_2019'] = np.log1p(merged['emp_2019'])
-    merged['naics2'] = merged['naics'].str[:2]
+from profiling import timed, stage
+
+def _quantile_row(q, res):
+    return {
+        'quantile': q,
+        'ec_coef': res['params']['ec_std'],
+        'ec_se': res['bse']['ec_std'],
+        'ec_pval': res['pvalues']['ec_std'],
+        'clustering_coef': res['params']['clustering_std'],
+        'clustering_se': res['bse']['clustering_std'],
+        'clustering_pval': res['pvalues']['clustering_std'],
+        'civic_coef': res['params']['civic_std'],
+        'civic_se': res['bse']['civic_std'],
+        'civic_pval': res['pvalues']['civic_std']
+    }
+
+@timed(rows = None)
+def run_quantreg(overwrite = False, resume = True, preprocess = None, workers = None,
+                 bootstrap_reps = 0, seed = 42, mmap = False):
+    # 2019 baseline / 2024 outcome, survivors only (cached)
+    required_cols = ['sales_2019', 'ec', 'fips', 'emp_2019', 'naics', 'clustering', 'civic']
+    x_cols = ['ec_std', 'clustering_std', 'civic_std', 'log_sales_2019']
 
     # define quantiles from 0.05 to 0.95
     quantiles = np.arange(0.05, 1.00, 0.05)
 
-    results = []
-
-    for q in tqdm(quantiles, desc="   Quantiles", ncols=70):
-        X = merged[['ec_std', 'clustering_std', 'civic_std', 'log_sales_2019']].assign(const=1)
-        model = QuantReg(merged['log_sales_change'], X)
-        res = model.fit(q=q)
-
-        results.append({
-            'quantile': q,
-            'ec_coef': res.params['ec_std'],
-            'ec_se': res.bse['ec_std'],
-            'ec_pval': res.pvalues['ec_std'],
-            'clustering_coef': res.params['clustering_std'],
-            'clustering_se': res.bse['clustering_std'],
-            'clustering_pval': res.pvalues['clustering_std'],
-            'civic_coef': res.params['civic_std'],
-            'civic_se': res.bse['civic_std'],
-            'civic_pval': res.pvalues['civic_std']
-        })
+    # design matrix built once; each quantile is warm started from its neighbour. With mmap
+    # it is read from an on-disk design that the workers open too, instead of a frame copy
+    if mmap:
+        merged = growth_design(x_cols, y_cols = ['log_sales_change'], codes = ['fips'],
+                               required_cols = required_cols, add_const = True, overwrite = overwrite)
+        X, y, names = merged['X'], merged['y']['log_sales_change'], merged['names']
+        clusters, data_key = merged['codes']['fips'], merged['key']
+    else:
+        merged = growth_frame(required_cols = required_cols, overwrite = overwrite)
+        X, y, names = design_matrix(merged, x_cols, 'log_sales_change')
+        clusters, data_key = merged['fips'].values, frame_hash(merged[x_cols + ['log_sales_change']])
+
+    # quantiles already fit on this exact sample are read back from the checkpoint
+    # preprocessing subsamples with the seed, so both decide the fitted taus
+    if preprocess is None:
+        preprocess = len(y) >= PREPROCESS_MIN_OBS
+    spec = {'y': 'log_sales_change', 'x_cols': x_cols, 'data': data_key, 'preprocess': preprocess, 'seed': seed}
+    if bootstrap_reps:
+        spec.update({'se': 'fips_bootstrap', 'reps': bootstrap_reps})
+    ckpt = checkpoint_path('quant_reg_results', spec)
+    done = load_checkpoint(ckpt, resume = resume)
+
+    todo = [q for q in quantiles if f"{q:.2f}" not in done]
+
+    fitted = {}
+    with stage('quantreg.grid', quantiles = len(todo), workers = workers) as record:
+        record['rows'] = len(y)
+        grid = fit_grid_parallel(X, y, names, todo, workers = workers, preprocess = preprocess, seed = seed)
+        for q, res in tqdm(grid, total=len(todo), desc="   Quantiles", ncols=70):
+            fitted[f"{q:.2f}"] = res
+            # with the bootstrap, rows are checkpointed once their clustered SEs are in
+            if not bootstrap_reps:
+                append_checkpoint(ckpt, f"{q:.2f}", _quantile_row(q, res))
+
+    if bootstrap_reps and fitted:
+        # county-clustered SEs: resample whole counties, refit every tau per replicate
+        qs = [q for q in todo if f"{q:.2f}" in fitted]
+        betas = [fitted[f"{q:.2f}"]['params'].values for q in qs]
+        with stage('quantreg.bootstrap', quantiles = len(qs), reps = bootstrap_reps, workers = workers) as record:
+            record['rows'] = len(y)
+            draws = cluster_bootstrap(X, y, clusters, qs, betas, reps = bootstrap_reps,
+                                      workers = workers, preprocess = preprocess, seed = seed)
+        for j, q in enumerate(qs):
+            res = fitted[f"{q:.2f}"]
+            res['bse'] = pd.Series(draws[:, j].std(axis = 0, ddof = 1), index = names)
+            res['pvalues'] = pd.Series(2 * stats.norm.sf(np.abs(res['params'] / res['bse'])), index = names)
+            append_checkpoint(ckpt, f"{q:.2f}", _quantile_row(q, res))
+
+    results = [done.get(f"{q:.2f}") or _quantile_row(q, fitted[f"{q:.2f}"]) for q in quantiles]
 
     results_df = pd.DataFrame(results)
 
@@ -131,7 +153,7 @@ def plot_quantile_results(results_df):
         ax.set_xticks(np.arange(0.1, 1.0, 0.1))
         
     plt.tight_layout()
-    path = paths()['figures']
+    path = paths()['plots']
     filename = os.path.join(path, 'quantile_regression_results.png')
     fig.savefig(filename, dpi = 600)
 
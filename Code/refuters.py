@@ -0,0 +1,162 @@
+# Parallel refutation battery for the backdoor linear estimate
+# Daman Dhaliwal
+
+# import libraries
+import pandas as pd
+import numpy as np
+import os
+import time
+from concurrent.futures import as_completed
+from scipy import stats
+
+from features import survival_frame
+from shared import SHARED, share_arrays, release_arrays, shared_pool, local_arrays
+from utils import paths, available_cores
+from profiling import timed
+
+REFUTERS = ('placebo', 'random_common_cause', 'data_subset', 'bootstrap')
+
+
+def backdoor_design(data, treatment, outcome, common_causes, effect_modifiers):
+    # same specification as dowhy's backdoor.linear_regression: outcome on the treatment,
+    # the common causes and treatment x effect-modifier interactions
+    base = [np.ones(len(data))] + [data[c].to_numpy(dtype = float) for c in common_causes]
+    modifiers = pd.get_dummies(data[list(effect_modifiers)].astype(str), drop_first = True)
+
+    B = np.column_stack(base)
+    M = modifiers.to_numpy(dtype = float)
+    t = data[treatment].to_numpy(dtype = float)
+    y = data[outcome].to_numpy(dtype = float)
+    return B, M, t, y
+
+def backdoor_effect(B, M, t, y, BtB = None, Bty = None):
+    # average marginal effect of the treatment; the treatment-free blocks of the
+    # normal equations can be passed in when only the treatment changes
+    T = np.column_stack([t, M * t[:, None]])
+    BtB = B.T @ B if BtB is None else BtB
+    Bty = B.T @ y if Bty is None else Bty
+    BtT = B.T @ T
+
+    gram = np.block([[BtB, BtT], [BtT.T, T.T @ T]])
+    rhs = np.concatenate([Bty, T.T @ y])
+    beta = np.linalg.lstsq(gram, rhs, rcond = None)[0]
+
+    effect = beta[B.shape[1]:]
+    return effect[0] + M.mean(axis = 0) @ effect[1:]
+
+def _simulate(refuter, seeds, sample_size, subset_fraction):
+    B, M, t, y = SHARED['B'], SHARED['M'], SHARED['t'], SHARED['y']
+    n = len(y)
+    size = min(sample_size or n, n)
+
+    start, wall = time.process_time(), time.perf_counter()
+    effects = []
+    for seed in seeds:
+        rng = np.random.default_rng(seed)
+        if refuter == 'bootstrap':
+            rows = rng.integers(0, n, size = size)
+        elif refuter == 'data_subset':
+            rows = rng.choice(n, size = int(subset_fraction * size), replace = False)
+        elif size < n:
+            rows = rng.choice(n, size = size, replace = False)
+        else:
+            rows = None
+
+        Bs, Ms, ts, ys = (B, M, t, y) if rows is None else (B[rows], M[rows], t[rows], y[rows])
+
+        if refuter == 'placebo':
+            # permuted treatment: only the treatment blocks of X'X change
+            BtB = SHARED['BtB'] if rows is None else None
+            Bty = SHARED['Bty'] if rows is None else None
+            effects.append(backdoor_effect(Bs, Ms, rng.permutation(ts), ys, BtB = BtB, Bty = Bty))
+        elif refuter == 'random_common_cause':
+            Bs = np.column_stack([Bs, rng.standard_normal(len(ys))])
+            effects.append(backdoor_effect(Bs, Ms, ts, ys))
+        else:
+            effects.append(backdoor_effect(Bs, Ms, ts, ys))
+
+    return refuter, effects, time.perf_counter() - wall, time.process_time() - start
+
+def _normal_test(estimate, effects):
+    # one-sided test of the estimate against the simulated distribution, as in dowhy
+    z = (estimate - np.mean(effects)) / np.std(effects)
+    return stats.norm.sf(z) if z > 0 else stats.norm.cdf(z)
+
+@timed(rows = None)
+def run_refuters(overwrite = False, refuters = REFUTERS, simulations = 100, sample_size = None,
+                 subset_fraction = 0.8, workers = None, seed = 42):
+    # same sample and specification as run_dowhy_robustness
+    subset_cols = ['survived_2022', 'ec', 'employees', 'naics2', 'fips', 'firm_age']
+    pdf = survival_frame(required_cols = subset_cols, overwrite = overwrite)
+
+    # design built once and shared by every simulation of every refuter
+    B, M, t, y = backdoor_design(pdf, treatment = 'ec_std', outcome = 'survived_2022',
+                                 common_causes = ['employees', 'firm_age'],
+                                 effect_modifiers = ['naics2', 'state'])
+    arrays = {'B': B, 'M': M, 't': t, 'y': y, 'BtB': B.T @ B, 'Bty': B.T @ y}
+    estimate = backdoor_effect(B, M, t, y, BtB = arrays['BtB'], Bty = arrays['Bty'])
+    print(f"   Baseline Estimate: {estimate:.5f}")
+
+    # independent seed streams per refuter, split into one chunk per worker
+    workers = workers or available_cores()
+    seed_seqs = np.random.SeedSequence(seed).spawn(len(refuters))
+    tasks = []
+    for refuter, seq in zip(refuters, seed_seqs):
+        seeds = seq.generate_state(simulations)
+        tasks += [(refuter, chunk) for chunk in np.array_split(seeds, workers) if len(chunk)]
+
+    effects = {r: [] for r in refuters}
+    cpu = {r: 0.0 for r in refuters}
+    wall = {r: 0.0 for r in refuters}
+    finished = {}
+    t0 = time.perf_counter()
+
+    # each refuter's own runtime is the sum of its chunks' durations; finished_at_s is
+    # when its last chunk came back, counted from the start of the battery
+    def collect(refuter, sims, wall_seconds, cpu_seconds):
+        effects[refuter] += sims
+        wall[refuter] += wall_seconds
+        cpu[refuter] += cpu_seconds
+        finished[refuter] = time.perf_counter() - t0
+
+    print(f"Running {len(refuters)} refuters x {simulations} simulations on {workers} workers")
+    if workers == 1:
+        with local_arrays(arrays):
+            for refuter, chunk in tasks:
+                collect(*_simulate(refuter, chunk, sample_size, subset_fraction))
+    else:
+        blocks, specs = share_arrays(arrays)
+        try:
+            with shared_pool(specs, workers) as pool:
+                futures = [pool.submit(_simulate, refuter, chunk, sample_size, subset_fraction)
+                           for refuter, chunk in tasks]
+                for future in as_completed(futures):
+                    collect(*future.result())
+        finally:
+            release_arrays(blocks)
+
+    results = pd.DataFrame([{
+        'refuter': r,
+        'estimated_effect': estimate,
+        'new_effect': np.mean(effects[r]),
+        'new_effect_sd': np.std(effects[r]),
+        'p_value': _normal_test(estimate, effects[r]),
+        'simulations': len(effects[r]),
+        'sample_size': min(sample_size or len(y), len(y)),
+        'wall_seconds': wall[r],
+        'cpu_seconds': cpu[r],
+        'finished_at_s': finished[r],
+    } for r in refuters])
+
+    print(f"\n   {'Refuter':<22} {'New effect':>12} {'p-value':>10} {'Wall (s)':>10} {'CPU (s)':>10}")
+    for _, row in results.iterrows():
+        print(f"   {row['refuter']:<22} {row['new_effect']:>12.5f} {row['p_value']:>10.4f} "
+              f"{row['wall_seconds']:>10.1f} {row['cpu_seconds']:>10.1f}")
+
+    filename = os.path.join(paths()['data'], 'refutation_results.csv')
+    results.to_csv(filename, index = False)
+
+    return results
+
+if __name__ == "__main__":
+    run_refuters()
@@ -0,0 +1,70 @@
+# Shared-memory arrays for process pools
+# Daman Dhaliwal
+
+# import libraries
+import numpy as np
+import mmap
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+from threadpoolctl import threadpool_limits
+from contextlib import contextmanager
+
+from utils import available_cores
+
+# arrays attached in this worker, by name; workers attach by name instead of
+# receiving a pickled copy of the design with every task
+SHARED = {}
+
+
+def _is_mapped(arr):
+    # a whole .npy/.dat file opened with np.load(mmap_mode=...) or np.memmap (not a slice of one)
+    return isinstance(arr, np.memmap) and arr.filename is not None and arr.flags.c_contiguous and isinstance(arr.base, mmap.mmap)
+
+def share_arrays(arrays):
+    # memory-mapped arrays are reopened from their file by each worker (the page cache is
+    # shared), anything else is copied once into a shared-memory block
+    blocks, specs = [], {}
+    for name, arr in arrays.items():
+        if _is_mapped(arr):
+            specs[name] = ('file', arr.filename, arr.offset, arr.shape, arr.dtype.str)
+            continue
+        shm = shared_memory.SharedMemory(create = True, size = max(arr.nbytes, 1))
+        np.ndarray(arr.shape, dtype = arr.dtype, buffer = shm.buf)[...] = arr
+        blocks.append(shm)
+        specs[name] = ('shm', shm.name, 0, arr.shape, arr.dtype.str)
+    return blocks, specs
+
+def attach_arrays(specs, threads):
+    # one BLAS thread per worker so the pool does not oversubscribe the cores
+    SHARED['limits'] = threadpool_limits(threads)
+    for name, (kind, ref, offset, shape, dtype) in specs.items():
+        if kind == 'file':
+            SHARED[name] = np.memmap(ref, dtype = dtype, mode = 'r', offset = offset, shape = shape)
+            continue
+        shm = shared_memory.SharedMemory(name = ref)
+        SHARED[f'_{name}_shm'] = shm
+        SHARED[name] = np.ndarray(shape, dtype = dtype, buffer = shm.buf)
+
+@contextmanager
+def local_arrays(arrays):
+    # serial runs: the worker functions read SHARED in this process; the arrays are
+    # dropped again afterwards so the module does not keep the design alive
+    SHARED.update(arrays)
+    try:
+        yield
+    finally:
+        for name in arrays:
+            SHARED.pop(name, None)
+
+def release_arrays(blocks):
+    for shm in blocks:
+        shm.close()
+        shm.unlink()
+
+def shared_pool(specs, workers):
+    threads = max(1, available_cores() // workers)
+    # spawn, since the BLAS/openmp thread pools are not fork-safe
+    ctx = multiprocessing.get_context('spawn')
+    return ProcessPoolExecutor(max_workers = workers, mp_context = ctx,
+                               initializer = attach_arrays, initargs = (specs, threads))
@@ -0,0 +1,155 @@
+# Out-of-core OLS from sufficient statistics with county-clustered standard errors
+# Daman Dhaliwal
+
+# import libraries
+import pandas as pd
+import numpy as np
+import polars as pl
+from scipy import stats
+
+from fe_ols import parse_formula
+from design import category_levels
+
+
+# a fixed effect with more levels than this is absorbed instead of expanded into dummies
+ABSORB_MIN_LEVELS = 100
+# ceiling on one dense batch of the design, in MB
+BATCH_BUDGET_MB = 512
+
+
+def _design(batch, regressors, fixed_effects, levels, intercept = True):
+    # dense design in patsy's layout: Intercept, C(fe)[T.level] dummies (first level dropped), regressors
+    n = batch.height
+    blocks = [np.ones((n, 1))] if intercept else []
+    for fe in fixed_effects:
+        codes = np.searchsorted(levels[fe], batch[fe].to_numpy())
+        dummies = np.zeros((n, len(levels[fe]) - 1))
+        rows = np.nonzero(codes > 0)[0]
+        dummies[rows, codes[rows] - 1] = 1.0
+        blocks.append(dummies)
+    blocks.append(batch.select(regressors).to_numpy().astype(float))
+    return np.hstack(blocks)
+
+def _names(regressors, fixed_effects, levels, intercept = True):
+    names = ['Intercept'] if intercept else []
+    for fe in fixed_effects:
+        names += [f"C({fe})[T.{level}]" for level in levels[fe][1:]]
+    return names + list(regressors)
+
+def _group_sums(codes, M, n_groups):
+    return np.column_stack([np.bincount(codes, weights = M[:, j], minlength = n_groups)
+                            for j in range(M.shape[1])])
+
+def stream_ols(lf, formula, cluster = 'fips', batch_size = 500_000, absorb = 'auto'):
+    # two passes over row batches: X'X and X'y for the coefficients, then per-cluster
+    # score sums for the sandwich; memory scales with clusters x regressors, not firms.
+    # The fixed effect with the most levels (above ABSORB_MIN_LEVELS, or the one named by
+    # absorb) is swept out with per-level sums instead of entering the dense batches.
+    y_col, regressors, fixed_effects = parse_formula(formula)
+    # the cluster column is often a fixed effect too, e.g. C(fips) clustered by fips
+    needed = list(dict.fromkeys([y_col] + regressors + fixed_effects + [cluster]))
+    lf = lf.select(needed).drop_nulls()
+
+    levels = category_levels(lf, list(dict.fromkeys(fixed_effects + [cluster])))
+    if absorb == 'auto':
+        largest = max(fixed_effects, key = lambda fe: len(levels[fe]), default = None)
+        absorb = largest if largest and len(levels[largest]) > ABSORB_MIN_LEVELS else None
+    dense_fe = [fe for fe in fixed_effects if fe != absorb]
+
+    # the absorbed effect replaces the intercept
+    names = _names(regressors, dense_fe, levels, intercept = absorb is None)
+    k = len(names)
+
+    # keep one dense batch within the memory budget
+    max_rows = max(1_000, int(BATCH_BUDGET_MB * 1024**2 / (8 * k)))
+    if batch_size > max_rows:
+        print(f"{k} dense columns: batch size lowered from {batch_size} to {max_rows}")
+        batch_size = max_rows
+
+    n_groups = len(levels[absorb]) if absorb else 1
+    group = lambda batch: np.searchsorted(levels[absorb], batch[absorb].to_numpy()) if absorb else np.zeros(batch.height, dtype = int)
+
+    xtx = np.zeros((k, k))
+    xty = np.zeros(k)
+    sx = np.zeros((n_groups, k))
+    sy = np.zeros(n_groups)
+    counts = np.zeros(n_groups)
+    n, y_sum, y_sq = 0, 0.0, 0.0
+    for batch in lf.collect_batches(chunk_size = batch_size):
+        X = _design(batch, regressors, dense_fe, levels, intercept = absorb is None)
+        y = batch[y_col].to_numpy().astype(float)
+        xtx += X.T @ X
+        xty += X.T @ y
+        n += len(y)
+        y_sum += y.sum()
+        y_sq += y @ y
+        if absorb:
+            g = group(batch)
+            sx += _group_sums(g, X, n_groups)
+            sy += np.bincount(g, weights = y, minlength = n_groups)
+            counts += np.bincount(g, minlength = n_groups)
+
+    keep = np.arange(k)
+    if absorb:
+        raw_ss = np.diag(xtx) - sx.sum(axis = 0) ** 2 / n
+        # within-group cross products: sum x x' - sum_g n_g xbar_g xbar_g'
+        present = counts > 0
+        mx = np.zeros_like(sx)
+        my = np.zeros_like(sy)
+        mx[present] = sx[present] / counts[present, None]
+        my[present] = sy[present] / counts[present]
+        xtx -= sx.T @ mx
+        xty -= sx.T @ my
+
+        # regressors the absorbed effect explains completely (a county variable under
+        # C(fips)) are omitted, as fe_ols does
+        dropped = np.diag(xtx) <= 1e-8 * np.maximum(raw_ss, 1e-300)
+        dropped[:k - len(regressors)] = False
+        if dropped.any():
+            print(f"Omitted (collinear with fixed effects): {', '.join(np.array(names)[dropped])}")
+        keep = np.nonzero(~dropped)[0]
+        xtx, xty = xtx[np.ix_(keep, keep)], xty[keep]
+        k_params = len(keep) + int(present.sum())
+    else:
+        k_params = k
+
+    bread = np.linalg.pinv(xtx)
+    beta = bread @ xty
+
+    n_clusters = len(levels[cluster])
+    score_sums = np.zeros((n_clusters, len(keep)))
+    ssr = 0.0
+    for batch in lf.collect_batches(chunk_size = batch_size):
+        X = _design(batch, regressors, dense_fe, levels, intercept = absorb is None)
+        y = batch[y_col].to_numpy().astype(float)
+        if absorb:
+            g = group(batch)
+            X = (X - mx[g])[:, keep]
+            y = y - my[g]
+        resid = y - X @ beta
+        c = np.searchsorted(levels[cluster], batch[cluster].to_numpy())
+        score_sums += _group_sums(c, X * resid[:, None], n_clusters)
+        ssr += resid @ resid
+
+    # same small-sample correction and normal p-values as statsmodels' cov_type='cluster'
+    correction = n_clusters / (n_clusters - 1) * (n - 1) / (n - k_params)
+    vcov = correction * bread @ (score_sums.T @ score_sums) @ bread
+    bse = np.sqrt(np.diag(vcov))
+    pvalues = 2 * stats.norm.sf(np.abs(beta / bse))
+
+    kept = [names[j] for j in keep]
+    result = {
+        'params': pd.Series(beta, index = kept).reindex(names),
+        'bse': pd.Series(bse, index = kept).reindex(names),
+        'pvalues': pd.Series(pvalues, index = kept).reindex(names),
+        'vcov': pd.DataFrame(vcov, index = kept, columns = kept).reindex(index = names, columns = names),
+        'nobs': n,
+        'n_clusters': n_clusters,
+        'r2': 1 - ssr / (y_sq - y_sum ** 2 / n),
+        'formula': formula,
+        'dep_var': y_col,
+        'fixed_effects': fixed_effects,
+    }
+    if absorb:
+        result['absorbed'] = absorb
+    return result
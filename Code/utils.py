@@ -21,4 +21,8 @@ def paths():
         'plots': plots_dir,
         'tables': tables_dir,
         'models': models_dir
-    }
\ No newline at end of file
+    }
+
+# cores this process may use: the pipeline gives each concurrently running node a share
+def available_cores():
+    return int(os.environ.get('SC_CORES') or os.cpu_count() or 1)
@@ -0,0 +1,60 @@
+import os
+import sys
+
+import numpy as np
+import polars as pl
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'Code'))
+
+import dml
+import features
+import nuisance
+import profiling
+
+
+@pytest.fixture
+def tmp_paths(tmp_path, monkeypatch):
+    # every output (features, nuisance cache, run log, csvs) under tmp_path
+    dirs = {
+        'parent_dir': str(tmp_path),
+        'data_input': str(tmp_path / 'Data') + '/',
+        'data': str(tmp_path / 'Output' / 'Data') + '/',
+        'plots': str(tmp_path / 'Output' / 'Plots') + '/',
+        'tables': str(tmp_path / 'Output' / 'Tables') + '/',
+        'models': str(tmp_path / 'Output' / 'Models') + '/',
+    }
+    os.makedirs(dirs['data'])
+    for module in [dml, features, nuisance, profiling]:
+        monkeypatch.setattr(module, 'paths', lambda: dirs)
+    return dirs
+
+def _survival_merged(n = 600, seed = 0):
+    rng = np.random.default_rng(seed)
+    fips = rng.integers(0, 30, n)
+    clustering = rng.standard_normal(30)[fips]
+    # counties without a clustering value, as in the SC Atlas
+    clustering[fips % 7 == 0] = np.nan
+    return pl.DataFrame({
+        'fips': [f"{10 + f // 10:02d}{f:03d}" for f in fips],
+        'employees': rng.integers(0, 200, n).astype(np.int32),
+        'sales': rng.exponential(1e5, n),
+        'naics': [f"{44 + k}{k:04d}" for k in rng.integers(0, 4, n)],
+        'survived_2024': rng.integers(0, 2, n).astype(np.int8),
+        'ec': rng.standard_normal(30)[fips],
+        'clustering': clustering,
+        'civic': rng.standard_normal(30)[fips],
+    })
+
+@pytest.mark.parametrize('categorical', [False, True])
+def test_gate_dml_drops_rows_missing_the_treatment(tmp_paths, categorical):
+    source = _survival_merged()
+    source.write_parquet(os.path.join(tmp_paths['data'], 'survival_merged.parquet'))
+
+    results = dml.run_gate_dml(groupings = ('naics2', 'size_bin'), categorical = categorical)
+
+    kept = source.filter(pl.col('clustering').is_not_nan()).height
+    assert kept < source.height
+    for grouping, gate in results.items():
+        assert gate['n'].sum() == kept
+        assert np.isfinite(gate['coef']).all()
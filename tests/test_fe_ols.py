@@ -0,0 +1,61 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'Code'))
+
+from fe_ols import fit_fe_batch, fit_fe_design, fit_fe_ols
+
+
+def _data(n = 3000, seed = 0):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({
+        'fips': rng.integers(0, 60, n),
+        'naics2': rng.integers(0, 8, n).astype(str),
+        'ec_std': rng.standard_normal(n),
+        'clustering_std': rng.standard_normal(n),
+        'log_employees': rng.standard_normal(n),
+    })
+    df['state'] = (df['fips'] // 10).astype(str)
+    df['y'] = 0.3 * df['ec_std'] - 0.2 * df['clustering_std'] + df['log_employees'] + rng.standard_normal(n)
+    # counties without a clustering value, as in the SC Atlas
+    df.loc[df['fips'] % 7 == 0, 'clustering_std'] = np.nan
+    return df
+
+def test_batch_matches_per_formula_fits_with_missing_regressor():
+    df = _data()
+    formulas = [
+        "y ~ ec_std + clustering_std + log_employees + C(state) + C(naics2)",
+        "y ~ ec_std + log_employees + C(state) + C(naics2)",
+        "y ~ clustering_std + log_employees + C(state) + C(naics2)",
+    ]
+    batch = fit_fe_batch(formulas, df)
+    for formula, result in zip(formulas, batch):
+        single = fit_fe_ols(formula, df)
+        assert result['nobs'] == single['nobs'] == len(df.dropna(subset = single['params'].index.tolist()))
+        pd.testing.assert_series_equal(result['params'], single['params'])
+        pd.testing.assert_series_equal(result['bse'], single['bse'])
+
+    # the variant without clustering keeps the counties that are missing it
+    assert batch[1]['nobs'] == len(df)
+    assert batch[0]['nobs'] < len(df)
+
+def test_design_batch_matches_frame_batch():
+    df = _data()
+    formulas = [
+        "y ~ ec_std + clustering_std + C(state)",
+        "y ~ ec_std + C(state)",
+    ]
+    regressors = ['ec_std', 'clustering_std']
+    design = {
+        'X': df[regressors].to_numpy(dtype = float),
+        'names': regressors,
+        'y': {'y': df['y'].to_numpy(dtype = float)},
+        'codes': {c: pd.factorize(df[c], sort = True)[0].astype(np.int32) for c in ['state', 'fips']},
+    }
+    for a, b in zip(fit_fe_design(formulas, design), fit_fe_batch(formulas, df)):
+        assert a['nobs'] == b['nobs']
+        np.testing.assert_allclose(a['params'], b['params'], rtol = 1e-10)
+        np.testing.assert_allclose(a['bse'], b['bse'], rtol = 1e-10)
@@ -0,0 +1,40 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import polars as pl
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'Code'))
+
+from fe_ols import fit_fe_ols
+from streaming_ols import stream_ols
+
+
+def _data(n = 5000, counties = 150, seed = 0):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({
+        'fips': rng.integers(0, counties, n),
+        'naics2': rng.integers(0, 8, n).astype(str),
+        'ec_std': rng.standard_normal(n),
+        'log_employees': rng.standard_normal(n),
+    })
+    county = rng.standard_normal(counties)
+    # a county-level regressor, which C(fips) explains completely
+    df['clustering_std'] = rng.standard_normal(counties)[df['fips']]
+    df['y'] = 0.3 * df['ec_std'] + df['log_employees'] + county[df['fips']] + rng.standard_normal(n)
+    return df
+
+def test_county_effect_absorbed_and_clustered_by_county():
+    df = _data()
+    formula = "y ~ ec_std + clustering_std + log_employees + C(naics2) + C(fips)"
+
+    streamed = stream_ols(pl.from_pandas(df).lazy(), formula, batch_size = 700)
+    fitted = fit_fe_ols(formula, df)
+
+    assert streamed['absorbed'] == 'fips'
+    assert streamed['nobs'] == fitted['nobs']
+    assert np.isnan(streamed['params']['clustering_std']) and np.isnan(fitted['params']['clustering_std'])
+    regressors = ['ec_std', 'log_employees']
+    np.testing.assert_allclose(streamed['params'][regressors], fitted['params'][regressors], rtol = 1e-10)
+    np.testing.assert_allclose(streamed['bse'][regressors], fitted['bse'][regressors], rtol = 1e-10)